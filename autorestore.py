@@ -2,10 +2,15 @@
 
 import os, sys
 from datetime import datetime, date, timedelta
-from backupcommon import BackupLock, BackupLogger, info, debug, error, exception, Configuration, BackupTemplate, scriptpath
+from backupcommon import BackupLock, BackupLogger, info, debug, error, exception, Configuration, BackupTemplate, scriptpath, create_snapshot_class
 from random import randint
+from subprocess import Popen, STDOUT
+from time import sleep
+from multiprocessing import Process, Queue
+from Queue import Empty
 from oraexec import OracleExec
 from restorecommon import RestoreDB
+from metrics import record_run
 from tempfile import mkstemp, TemporaryFile
 
 def printhelp():
@@ -32,14 +37,27 @@ if (not os.getenv('AUTORESTORE_SAFE_SANDBOX')) or (os.environ['AUTORESTORE_SAFE_
     sys.exit(3)
 
 Configuration.init('autorestore', configfilename=sys.argv[1], additionaldefaults={'customverifydate': 'select max(time_dp) from sys.smon_scn_time','autorestoreenabled': '1',
-    'autorestoreinstancenumber': '1', 'autorestorethread': '1'})
+    'autorestoreinstancenumber': '1', 'autorestorethread': '1', 'autorestoreslots': '1', 'autorestorepipeline': 'false'})
 oexec = OracleExec(oraclehome=Configuration.get('oraclehome', 'generic'), tnspath=os.path.join(scriptpath(), Configuration.get('tnsadmin', 'generic')))
 restoretemplate = BackupTemplate('restoretemplate.cfg')
 
 exitstatus = 0
+# Restore slot used by this process, slots are numbered from 1
+slot = int(os.getenv('AUTORESTORE_SLOT', '1'))
+# Processes started by loopslots leave the shared log directory cleanup to the parent process
+slotchild = os.getenv('AUTORESTORE_SLOT') is not None
 
 # System actions
 
+def slotparameter(parameter, forslot=None):
+    # Slot 1 uses the regular autorestore parameters, other slots have the slot number as a suffix
+    s = slot if forslot is None else forslot
+    return parameter if s == 1 else "%s%d" % (parameter, s)
+
+def slotlockname(forslot=None):
+    s = slot if forslot is None else forslot
+    return 'backup.lck' if s == 1 else "slot%d.lck" % s
+
 # Clean destination directory
 def cleantarget(restoredest):
     debug("ACTION: Cleaning destination directory %s" % restoredest)
@@ -68,13 +86,14 @@ def validationdate(database):
     next_validation = date.today() + timedelta(days=days_to_next_validation)
     return (validatecorruption, days_to_next_validation, next_validation)
 
-def runrestore(database):
+def runrestore(database, preparedsnapid=None, background=False):
+    # If background is True, the result logging and cleanup run in a separate process that is returned
     global exitstatus
     #
     Configuration.defaultsection = database
     #
-    restoredest = Configuration.get('autorestoredestination','autorestore')
-    mountdest = Configuration.get('autorestoremountpoint','autorestore')
+    restoredest = Configuration.get(slotparameter('autorestoredestination'),'autorestore')
+    mountdest = Configuration.get(slotparameter('autorestoremountpoint'),'autorestore')
     logdir = Configuration.get('autorestorelogdir','autorestore')
     Configuration.substitutions.update({
         'logdir': logdir,
@@ -91,13 +110,21 @@ def runrestore(database):
     validatemodulus = int(Configuration.get('autorestoremodulus', 'autorestore'))
     # Reinitialize logging
     BackupLogger.init(os.path.join(logdir, "%s-%s.log" % (datetime.now().strftime('%Y%m%dT%H%M%S'), database)), database)
-    BackupLogger.clean()
+    if not slotchild:
+        BackupLogger.clean()
     #
     restore = RestoreDB(database)
     restore.set_mount_path(mountdest)
     restore.set_restore_path(restoredest)
+    restore.set_autoclone_name(Configuration.get(slotparameter('autorestoreclonename'),'autorestore'))
+    if preparedsnapid is not None:
+        restore.set_prepared_clone(preparedsnapid)
+    if slot > 1:
+        restore.set_sid_suffix("s%d" % slot)
     #
     info("Logfile: %s" % BackupLogger.logfile)
+    if slot > 1:
+        info("Restore slot: %d" % slot)
     Configuration.substitutions.update({
         'logfile': BackupLogger.logfile
     })
@@ -138,6 +165,16 @@ def runrestore(database):
         'log_snapid': restore.sourcesnapid,
         'log_validated': '1' if validatecorruption else '0'
     })
+    if background:
+        p = Process(target=finishrestore, args=(database, restore, success, logdir))
+        p.start()
+        BackupLogger.close(True)
+        return p
+    else:
+        finishrestore(database, restore, success, logdir)
+
+def finishrestore(database, restore, success, logdir):
+    # Log result to catalog and clean up the diagnostic directory
     debug('Logging the result to catalog.')
     try:
         oexec.sqlldr(Configuration.get('autorestorecatalog','autorestore'), restoretemplate.get('sqlldrlog'))
@@ -149,6 +186,16 @@ def runrestore(database):
         debug("Logging the result to catalog failed.")
     # Finish up
     info("Restore %s, elapsed time: %s" % ('successful' if success else 'failed', restore.endtime-restore.starttime))
+    record_run('autorestore', database, 'restore', restore.starttime, success, {
+        'duration_seconds': (restore.endtime-restore.starttime).total_seconds(),
+        'verification_diff_seconds': restore.verifyseconds if success else None,
+        'validated': int(Configuration.substitutions['log_validated'])})
+    if not slotchild:
+        purgediag(logdir)
+    #
+    BackupLogger.close(True)
+
+def purgediag(logdir):
     # Run ADRCI to clean up diag
     adrage = int(Configuration.get('logretention','generic'))*1440
     f1 = mkstemp(suffix=".adi")
@@ -178,8 +225,79 @@ def runrestore(database):
         finally:
             os.unlink(f1[1])
             os.unlink(f2[1])
-    #
-    BackupLogger.close(True)
+
+# Pipelined restore
+
+def prepareclone(database, clonename, resultqueue):
+    # Executed in a separate process, clones the snapshot for the next database while the current one is restored
+    snapid = None
+    try:
+        BackupLogger.close()
+        Configuration.defaultsection = database
+        snapid = create_snapshot_class(database).autoclone(clonename)
+    except:
+        exception("Preparing clone %s for %s failed." % (clonename, database))
+    finally:
+        resultqueue.put(snapid)
+
+def preparedclone(prepared):
+    # Waits for the prepareclone process to finish, returns snapshot id or None
+    p, resultqueue = prepared
+    p.join()
+    try:
+        return resultqueue.get(timeout=10)
+    except Empty:
+        return None
+
+def looppipeline():
+    global slot
+    databases = list(loopdatabases())
+    # Clones are prepared in advance only if the second slot is configured, databases then alternate between slots 1 and 2
+    try:
+        for parameter in ['autorestoredestination', 'autorestoremountpoint', 'autorestoreclonename']:
+            Configuration.get(slotparameter(parameter, 2), 'autorestore')
+        slots = [1, 2]
+    except:
+        slots = [1]
+    locks = []
+    finishing = None
+    prepared = None
+    preparedfor = None
+    try:
+        for s in slots:
+            locks.append(BackupLock(Configuration.get('autorestorelogdir','autorestore'), lockname=slotlockname(s)))
+        for idx, configname in enumerate(databases):
+            slot = slots[idx % len(slots)]
+            preparedsnapid = None
+            if prepared is not None:
+                preparedsnapid = preparedclone(prepared)
+                prepared = None
+            if len(slots) > 1 and idx+1 < len(databases):
+                # Start cloning for the next database using the other slot
+                nextslot = slots[(idx+1) % len(slots)]
+                Configuration.defaultsection = databases[idx+1]
+                resultqueue = Queue()
+                p = Process(target=prepareclone, args=(databases[idx+1], Configuration.get(slotparameter('autorestoreclonename', nextslot), 'autorestore'), resultqueue))
+                p.start()
+                prepared = (p, resultqueue)
+                preparedfor = databases[idx+1]
+            finished = runrestore(configname, preparedsnapid, background=True)
+            # Keep only one database logging its results in the background
+            if finishing is not None:
+                finishing.join()
+            finishing = finished
+    finally:
+        if prepared is not None and preparedclone(prepared) is not None:
+            # Loop was interrupted, drop the clone that was prepared for the next database
+            Configuration.defaultsection = preparedfor
+            try:
+                create_snapshot_class(preparedfor).dropautoclone(Configuration.get(slotparameter('autorestoreclonename', nextslot), 'autorestore'))
+            except:
+                exception("Dropping prepared clone for %s failed." % preparedfor)
+        if finishing is not None:
+            finishing.join()
+        for lock in locks:
+            lock.release()
 
 # UI
 
@@ -196,6 +314,38 @@ def loopdatabases():
             if Configuration.get('autorestoreenabled', configname) == '1':
                 yield configname
 
+def loopslots(slots):
+    # Restores each database in a separate autorestore.py process, up to one database per slot at a time
+    global exitstatus
+    running = {}
+    databases = list(loopdatabases())
+    while databases or running:
+        for s, r in running.items():
+            if r['process'].poll() is not None:
+                del running[s]
+                print "--- DATABASE: %s (slot %d) exit code %d ---" % (r['dbname'], s, r['process'].returncode)
+                r['output'].seek(0,0)
+                for line in r['output']:
+                    sys.stdout.write(line)
+                r['output'].close()
+                sys.stdout.flush()
+                if r['process'].returncode != 0:
+                    exitstatus = 1
+        for s in range(1, slots+1):
+            if databases and s not in running:
+                configname = databases.pop(0)
+                env = os.environ.copy()
+                env['AUTORESTORE_SLOT'] = str(s)
+                output = TemporaryFile()
+                p = Popen([os.path.join(scriptpath(), 'autorestore.py'), sys.argv[1], configname], stdout=output, stderr=STDOUT, env=env)
+                running[s] = {'dbname': configname, 'process': p, 'output': output}
+        if running:
+            sleep(5)
+    # Shared log directory is cleaned only after all slots have finished
+    logdir = Configuration.get('autorestorelogdir','autorestore')
+    BackupLogger.clean(logdir)
+    purgediag(logdir)
+
 action = None
 if len(sys.argv) == 3:
     action = sys.argv[2]
@@ -220,11 +370,17 @@ else:
             info("Logfile: %s" % BackupLogger.logfile)
             Configuration.substitutions.update({'logfile': BackupLogger.logfile})
             oexec.sqlplus(restoretemplate.get('createcatalog'), silent=False)
+    elif os.getenv('AUTORESTORE_SLOT') is None and int(Configuration.get('autorestoreslots', 'autorestore')) > 1:
+        # Restore multiple databases concurrently, each slot has its own destination, mount point, clone and lock
+        loopslots(int(Configuration.get('autorestoreslots', 'autorestore')))
+    elif os.getenv('AUTORESTORE_SLOT') is None and Configuration.get('autorestorepipeline', 'autorestore').upper() == 'TRUE':
+        # Overlap storage operations and result logging with the restore of the current database
+        looppipeline()
     else:
         # Loop through all sections
         for configname in loopdatabases():
             Configuration.defaultsection = configname
-            lock = BackupLock(Configuration.get('autorestorelogdir','autorestore'))
+            lock = BackupLock(Configuration.get('autorestorelogdir','autorestore'), lockname=slotlockname())
             try:
                 runrestore(configname)
             finally:
@@ -1,11 +1,14 @@
 #!/usr/bin/python2
 
-import os, ConfigParser, sys
+import os, ConfigParser, sys, re
 from datetime import datetime, timedelta
 from subprocess import Popen, PIPE, STDOUT
 from tempfile import TemporaryFile
-from backupcommon import BackupLock, BackupLogger, info, debug, error, exception, scriptpath, Configuration, BackupTemplate, create_snapshot_class
+from string import Template
+from backupcommon import BackupLock, BackupLogger, info, debug, error, exception, scriptpath, size2str, Configuration, BackupTemplate, PhaseTrace, CachedCommand, create_snapshot_class
 from oraexec import OracleExec
+from metrics import record_run, metricsfile
+from rmantuner import RmanTuner, channelrate, sectionsize2bytes
 
 # Check command line arguments
 uioptions = ['config','setschedule','backupimagecopy','report','validatebackup','generaterestore','imagecopywithsnap','missingarchlog']
@@ -40,10 +43,18 @@ else:
     backupdest = Configuration.get('backupdest', 'generic')
 archdir = os.path.join(backupdest, 'archivelog')
 hasdataguard = Configuration.get('hasdataguard').upper() == 'TRUE'
+rmanautotune = Configuration.get('rmanautotune').lower()
+racchannels = Configuration.get('racchannels').upper() == 'TRUE'
+standbytns = Configuration.get('standbytns') if hasdataguard else ''
 dosnapshot = Configuration.get('dosnapshot').upper() == 'TRUE'
 gimanaged = Configuration.get('gimanaged').upper() == 'TRUE'
 registercatalog = Configuration.get('registercatalog').upper() == 'TRUE'
 
+# Without catalog the backups taken on standby would be recorded only in the standby controlfile
+if standbytns and not registercatalog:
+    print "Parameter standbytns requires registercatalog to be true."
+    sys.exit(2)
+
 # Log file for this session
 logdir = os.path.join(backupdest, 'backup_logs')
 logfile = os.path.join(logdir, "%s_%s_%s.log" % (configsection, datetime.now().strftime('%Y%m%dT%H%M%S'), scriptaction) )
@@ -51,8 +62,17 @@ print "Log file for this session: %s" % logfile
 BackupLogger.init(logfile, configsection)
 BackupLogger.clean()
 
+# Timing spans of the script phases are written next to the log file
+trace = PhaseTrace("%s.trace.json" % os.path.splitext(logfile)[0])
+
 # Oracle environment variables
 oraexec = OracleExec(Configuration.get('oraclehome', 'generic'), os.path.join(scriptpath, Configuration.get('tnsadmin', 'generic')))
+if Configuration.get('sqlplussession', 'generic').upper() == 'TRUE':
+    oraexec.startsession()
+if Configuration.get('rmanmonitor', 'generic').upper() == 'TRUE':
+    oraexec.monitorrman(os.path.join(logdir, "%s_rmanstatus.json" % configsection), int(Configuration.get('rmanmonitorinterval', 'generic')))
+if Configuration.get('longopsmonitor', 'generic').upper() == 'TRUE':
+    oraexec.monitorlongops('/@%s as sysdba' % configsection, os.path.join(logdir, "%s_longops.json" % configsection), int(Configuration.get('longopsinterval', 'generic')), "%s %s" % (configsection, scriptaction))
 
 # Prepare a dictionary of all possible template substitutions
 Configuration.substitutions.update({ 'recoverywindow': Configuration.get('recoverywindow'),
@@ -61,6 +81,7 @@ Configuration.substitutions.update({ 'recoverywindow': Configuration.get('recove
                   'archdir': archdir,
                   'catalogconnect': Configuration.get('catalog', 'rman'),
                   'configname': configsection,
+                  'rmantarget': configsection,
                   'osuser': Configuration.get('osuser', 'generic'),
                   'ospassword': os.getenv('OSPASSWORD'),
                   'scriptpath': scriptpath,
@@ -70,6 +91,7 @@ Configuration.substitutions.update({ 'recoverywindow': Configuration.get('recove
                   'oraclehome': oraexec.oraclehome,
                   'tnspath': oraexec.tnspath,
                   'logfile': logfile,
+                  'dataguardmaxwait': int(Configuration.get('dataguardmaxwait')),
                   'backupjobenabled': 'true' if Configuration.get('backupjobenabled').upper() == 'TRUE' else 'false',
                   'sectionsize': "section size %s" % Configuration.get('sectionsize', 'rman') if Configuration.get('sectionsize', 'rman') else ''
                 })
@@ -81,18 +103,23 @@ rmantemplateconfig = BackupTemplate('rmantemplate.cfg')
 snap = create_snapshot_class(configsection)
 
 # Execute RMAN with script as input
-def exec_rman(rmanscript):
+def exec_rman(rmanscript, target=None):
     # Modify rman script with common headers
+    Configuration.substitutions['rmantarget'] = target or configsection
     finalscript = rmantemplateconfig.get('header')
     if registercatalog:
         finalscript+= "\n%s" % rmantemplateconfig.get('headercatalog')
     finalscript+= "\n%s" % rmanscript
     finalscript+= "\n%s" % rmantemplateconfig.get('footer')
     # print finalscript
-    oraexec.rman(finalscript)
+    with trace.span('rman') as s:
+        try:
+            oraexec.rman(finalscript)
+        finally:
+            s.update(oraexec.lastrman)
 
-# Execute sqlplus with a given script
-def exec_sqlplus(sqlplusscript, silent=False, header=True, primary=False):
+# Add sqlplus headers to a given script
+def sqlplus_script(sqlplusscript, header=True, primary=False):
     global configsection
     Configuration.substitutions['sqlplusconnection'] = '/@%s as sysdba' % (Configuration.get('primarytns') if primary else configsection)
     script = ""
@@ -101,7 +128,41 @@ def exec_sqlplus(sqlplusscript, silent=False, header=True, primary=False):
     script+= "%s\n" % sqlplusscript
     if header:
         script+= "%s\n" % rmantemplateconfig.get('sqlplusfooter')
-    return oraexec.sqlplus(script, silent)
+    return script
+
+# Execute sqlplus with a given script
+def exec_sqlplus(sqlplusscript, silent=False, header=True, primary=False):
+    return oraexec.sqlplus(sqlplus_script(sqlplusscript, header, primary), silent)
+
+# Execute sqlplus with a given script, returns a generator of output lines
+def exec_sqlplus_lines(sqlplusscript, header=True, primary=False):
+    return oraexec.sqlplus_lines(sqlplus_script(sqlplusscript, header, primary))
+
+# Execute multiple scripts in one sqlplus session
+# probes is a list of tuples (name, script, primary), returns dictionary of output lines for each probe name
+def exec_probes(probes):
+    script = ""
+    firstconnection = None
+    currentconnection = None
+    for name, probescript, primary in probes:
+        connection = '/@%s as sysdba' % (Configuration.get('primarytns') if primary else configsection)
+        if firstconnection is None:
+            firstconnection = connection
+        elif connection != currentconnection:
+            script+= "conn %s\n" % connection
+        currentconnection = connection
+        script+= "prompt PROBE-BEGIN: %s\n%s\nprompt PROBE-END: %s\n" % (name, probescript, name)
+    Configuration.substitutions['sqlplusconnection'] = firstconnection
+    results = dict([(name, []) for name, probescript, primary in probes])
+    current = None
+    for line in oraexec.sqlplus_lines("%s\n%s%s\n" % (rmantemplateconfig.get('sqlplusheader'), script, rmantemplateconfig.get('sqlplusfooter'))):
+        if line.startswith('PROBE-BEGIN: '):
+            current = line.strip()[13:]
+        elif line.startswith('PROBE-END: '):
+            current = None
+        elif current is not None:
+            results[current].append(line.rstrip('\n'))
+    return results
 
 ##############
 # User actions
@@ -134,7 +195,7 @@ def configure():
     info("Running additional configuration from SQL*Plus")
     exec_sqlplus(rmantemplateconfig.get('configfromsqlplus'))
 
-def backup(level):
+def backup(level, channels=None, target=None, existingcopies=False):
     entry = 'backup'
     if level == '1c':
         entry+= 'cumulative'
@@ -146,96 +207,271 @@ def backup(level):
         entry+= 'imagecopy'
     else:
         entry+= 'full'
+    # Explicitly allocated channels override the configured parallelism for this run block
+    # channels is a list of connect strings, None connects the channel to the target database
+    allocate = ""
+    for i, connect in enumerate(channels or []):
+        Configuration.substitutions['channelname'] = "c%d" % (i+1)
+        Configuration.substitutions['channelconnect'] = "connect '%s'" % connect if connect else ''
+        allocate+= "%s\n" % rmantemplateconfig.get('allocatebackupchannel')
+    if level == 'imagecopy' and target:
+        # Only the incremental backup and merge run on standby, spfile and controlfile backups and cleanup stay on primary
+        # Existing image copies were created by primary, standby can merge them only after they are associated with it
+        standbyscript = ""
+        if existingcopies:
+            standbyscript+= "%s\n" % rmantemplateconfig.get('imagecopyresetowner')
+        standbyscript+= "run {\n%s%s\n%s\n}\n" % (allocate, rmantemplateconfig.get(entry), rmantemplateconfig.get('standbyimagecopyfinish'))
+        exec_rman(standbyscript, target)
+        exec_rman("%s\nrun {\n%s\n%s\n}\n" % (rmantemplateconfig.get('imagecopyresetowner'), rmantemplateconfig.get('backupimagecopyfinish'), rmantemplateconfig.get('backupfooter')))
+        return
+    if level == 'imagecopy':
+        entry = "%s\n%s" % (rmantemplateconfig.get(entry), rmantemplateconfig.get('backupimagecopyfinish'))
+    else:
+        entry = rmantemplateconfig.get(entry)
     # Execute backup commands inside run block
-    rmanscript = "run {\n%s\n%s\n}\n" % (rmantemplateconfig.get(entry), rmantemplateconfig.get('backupfooter'))
-    exec_rman(rmanscript)
+    rmanscript = "run {\n%s%s\n%s\n}\n" % (allocate, entry, rmantemplateconfig.get('backupfooter'))
+    exec_rman(rmanscript, target)
 
-def backup_missing_archlog():
-    output = exec_sqlplus(rmantemplateconfig.get('archivelogmissing'), silent=True)
-    archlogscript = ""
-    for line in output.splitlines():
-        if line.startswith('BACKUP force as copy'):
-            archlogscript+= "%s\n" % line.strip()
+def backup_missing_archlog(output=None):
+    # output can be supplied from a combined probe session
+    archlogscript = []
+    with trace.span('query missing archivelogs') as s:
+        if output is None:
+            output = exec_sqlplus_lines(rmantemplateconfig.get('archivelogmissing'))
+        for line in output:
+            if line.startswith('BACKUP force as copy'):
+                archlogscript.append(line.strip())
+        s['archivelogs'] = len(archlogscript)
     if archlogscript:
         info("- Copying missing archivelogs")
-        exec_rman("run {\n%s\n%s\n}" % (rmantemplateconfig.get('allocatearchlogchannel'), archlogscript))
+        exec_rman("run {\n%s\n%s\n}" % (rmantemplateconfig.get('allocatearchlogchannel'), "\n".join(archlogscript)))
 
-def delete_expired_datafilecopy():
-    output = exec_sqlplus(rmantemplateconfig.get('deletedatafilecopy'), silent=True)
-    rmanscript = ""
-    for line in output.splitlines():
-        if line.startswith('DELETECOPY: '):
-            rmanscript+= "%s\n" % line.strip()[12:]
+def delete_expired_datafilecopy(output=None):
+    # output can be supplied from a combined probe session
+    rmanscript = []
+    with trace.span('query expired datafile copies') as s:
+        if output is None:
+            output = exec_sqlplus_lines(rmantemplateconfig.get('deletedatafilecopy'))
+        for line in output:
+            if line.startswith('DELETECOPY: '):
+                rmanscript.append(line.strip()[12:])
+        s['datafilecopies'] = len(rmanscript)
     if rmanscript:
         info("- Deleting expired datafile copies")
-        exec_rman(rmanscript)
+        exec_rman("%s\n" % "\n".join(rmanscript))
+
+def archivecurrentlogs():
+    # Log switch script, with Data Guard wait when database has a standby
+    script = rmantemplateconfig.get('archivecurrentlogs')
+    if hasdataguard:
+        script+= "\n%s" % rmantemplateconfig.get('dataguardwait')
+    return script
+
+def autotune(output):
+    # Chooses RMAN parallelism and section size for the imagecopy merge from datafile sizes and earlier runs
+    # Returns plan that is used for the merge and the number of channels to allocate (None keeps the configured parallelism)
+    sizes = [int(line.split()[2]) for line in output if line.startswith('DATAFILE-SIZE: ')]
+    if not sizes:
+        info("RMAN autotune: datafile sizes not available, using configured parallelism")
+        return None, None
+    rate = None
+    if Configuration.get('metricsdb', 'generic'):
+        try:
+            rate = channelrate(metricsfile(), configsection)
+        except Exception as detail:
+            debug("Reading channel throughput history failed: %s" % detail)
+    tuner = RmanTuner(sizes, int(Configuration.get('autotunemaxparallel')), rate)
+    configured = tuner.plan(int(Configuration.get('parallel')), sectionsize2bytes(Configuration.get('sectionsize', 'rman')))
+    recommended = tuner.recommend()
+    info("RMAN autotune: %d datafiles, %s total, largest %s, busiest channel history %s" % (len(sizes), size2str(sum(sizes)), size2str(max(sizes)),
+        "%.1f MB/s" % (rate / 1048576) if rate else 'not available'))
+    for label, plan in [('configured', configured), ('recommended', recommended)]:
+        info("RMAN autotune %s: parallel %d, %s, busiest channel %s, channel balance %d%%, predicted duration %s" % (label, plan.parallel,
+            plan.sectionclause() or 'no section size', size2str(plan.maxchannelbytes), round(100*plan.balance()),
+            timedelta(seconds=int(plan.seconds)) if plan.seconds is not None else 'unknown'))
+    if rmanautotune == 'apply':
+        Configuration.substitutions['sectionsize'] = recommended.sectionclause()
+        return recommended, recommended.parallel
+    return configured, None
+
+def racinstances():
+    # Names of the running instances of this database from Grid Infrastructure
+    p = Popen([os.path.join(oraexec.oraclehome, 'bin', 'srvctl'), 'status', 'database', '-d', configsection], stdout=PIPE, stderr=STDOUT, stdin=None,
+              env=dict(os.environ, ORACLE_HOME=oraexec.oraclehome))
+    output,outerr = p.communicate()
+    if p.returncode != 0:
+        debug(output)
+        return []
+    return re.findall(r'^Instance (\S+) is running on node', output, re.MULTILINE)
+
+def channelconnects(parallel):
+    # Connect strings for the channels of the imagecopy merge, channels are spread evenly over the running RAC instances
+    if standbytns:
+        # Standby has no channel configuration from config action, channels must write to backupdest
+        return [None] * (parallel or int(Configuration.get('parallel')))
+    if not racchannels:
+        return [None] * (parallel or 0)
+    instances = racinstances() if gimanaged else []
+    if len(instances) < 2:
+        info("RAC channels: %d running instances found, channels connect through the target database" % len(instances))
+        return [None] * (parallel or 0)
+    connects = []
+    for i in range(parallel or int(Configuration.get('parallel'))):
+        alias = Template(Configuration.get('racinstancetns')).substitute(Configuration.substitutions, instance=instances[i % len(instances)])
+        connects.append("/@%s" % alias)
+    info("RAC channels: %d channels over instances %s" % (len(connects), ", ".join(instances)))
+    return connects
+
+def environmentcommands():
+    # dbinfo.py and opatch output written to the log file, opatch output is cached until ORACLE_HOME inventory changes
+    oraclehome = Configuration.get('oraclehome', 'generic')
+    statefiles = [os.path.join(oraclehome, 'inventory', 'ContentsXML'), os.path.join(oraclehome, 'inventory', 'ContentsXML', 'comps.xml'),
+                  os.path.join(oraclehome, '.patch_storage'), os.path.join(oraclehome, 'OPatch')]
+    cachedir = os.path.join(scriptpath, Configuration.get('envcachedir', 'generic'))
+    maxage = timedelta(hours=int(Configuration.get('envcachemaxage', 'generic')))
+    commands = []
+    if gimanaged:
+        # Cluster and instance state in dbinfo.py output must be current, so it is never cached
+        commands.append(('dbinfo', CachedCommand([os.path.join(scriptpath, 'dbinfo.py'), configsection], [], cachedir, timedelta(0))))
+    # ORACLE_HOME patch information
+    commands.append(('opatch lsinventory', CachedCommand([os.path.join(oraclehome, 'OPatch', 'opatch'), 'lsinventory'], statefiles, cachedir, maxage)))
+    return commands
 
 def imagecopywithsnap():
     starttime = datetime.now()
     restoreparamfile = os.path.join(backupdest, 'autorestore.cfg')
     #
-    info("Check if there are missing archivelogs")
-    backup_missing_archlog()
+    info("Query missing archivelogs and expired datafile copies, switch current log")
+    with trace.span('pre-backup probe') as s:
+        probes = exec_probes([('archivelogmissing', rmantemplateconfig.get('archivelogmissing'), False),
+                              ('deletedatafilecopy', rmantemplateconfig.get('deletedatafilecopy'), False),
+                              ('archivecurrentlogs', archivecurrentlogs(), True)] +
+                             ([('datafilesizes', rmantemplateconfig.get('datafilesizes'), False)] if rmanautotune != 'off' else []) +
+                             ([('imagecopycount', rmantemplateconfig.get('imagecopycount'), False)] if standbytns else []))
+        s['bytesread'] = sum([len(line) for lines in probes.values() for line in lines])
+        if os.path.isfile(restoreparamfile):
+            with open(restoreparamfile, 'a') as f:
+                for line in probes['archivecurrentlogs']:
+                    if line.startswith('CURRENT DATABASE SCN:'):
+                        f.write("lastscn: %s\n" % line.strip()[22:])
+                    elif line.startswith('CURRENT DATABASE TIME:'):
+                        f.write("lasttime: %s\n" % line.strip()[23:])
+                    elif line.startswith('BCT FILE:'):
+                        f.write("bctfile: %s\n" % line.strip()[10:])
+                    elif line.startswith('DATAGUARD WAIT:'):
+                        debug(line.strip())
     #
-    info("Switch current log")
-    output = exec_sqlplus(rmantemplateconfig.get('archivecurrentlogs'), silent=True, primary=True)
-    if os.path.isfile(restoreparamfile):
-        with open(restoreparamfile, 'a') as f:
-            for line in output.splitlines():
-                if line.startswith('CURRENT DATABASE SCN:'):
-                    f.write("lastscn: %s\n" % line.strip()[22:])
-                elif line.startswith('CURRENT DATABASE TIME:'):
-                    f.write("lasttime: %s\n" % line.strip()[23:])
-                elif line.startswith('BCT FILE:'):
-                    f.write("bctfile: %s\n" % line.strip()[10:])
+    info("Check if there are missing archivelogs")
+    with trace.span('missing archivelog copy'):
+        backup_missing_archlog(probes['archivelogmissing'])
     #
     if dosnapshot:
         info("Snap the current backup area")
-        snapid = snap.snap()
+        with trace.span('storage snapshot') as s:
+            snapid = snap.snap()
+            s['snapid'] = snapid
         debug("Created snapshot: %s" % snapid)
     #
     info("Checking for expired datafile copies")
-    delete_expired_datafilecopy()
+    with trace.span('expired datafile copy delete'):
+        delete_expired_datafilecopy(probes['deletedatafilecopy'])
+    #
+    # Environment information is collected in the background during the merge
+    envcommands = environmentcommands()
+    for name, c in envcommands:
+        c.start()
+    #
+    plan, parallel = None, None
+    if rmanautotune != 'off':
+        plan, parallel = autotune(probes['datafilesizes'])
+    #
+    channels = channelconnects(parallel)
+    existingcopies = False
+    if standbytns:
+        info("Incremental backup and merge are offloaded to Data Guard standby %s" % standbytns)
+        for line in probes['imagecopycount']:
+            if line.startswith('IMAGECOPY-COUNT: '):
+                existingcopies = int(line.strip()[17:]) > 0
     #
     info("Refresh imagecopy")
-    backup('imagecopy')
-    exec_sqlplus(rmantemplateconfig.get('archivecurrentlogs'), primary=True)
+    with trace.span('imagecopy merge') as s:
+        if plan is not None:
+            s.update({'channels': plan.parallel, 'maxchannelbytes': plan.maxchannelbytes})
+            if plan.seconds is not None:
+                s['predictedseconds'] = plan.seconds
+        s.update({'instances': len(set([c for c in channels if c])), 'standby': bool(standbytns)})
+        backup('imagecopy', channels, standbytns or None, existingcopies)
+    with trace.span('post-backup probe'):
+        probes = exec_probes([('archivecurrentlogs', archivecurrentlogs(), True),
+                              ('autorestoreparameters', rmantemplateconfig.get('autorestoreparameters'), False)])
     #
     if dosnapshot:
         info("Clean expired snapshots")
-        cleaningresult = snap.clean()
-        for r in cleaningresult:
-            debug(r['infostring'])
+        with trace.span('snapshot clean') as s:
+            cleaningresult = snap.clean()
+            s['dropped'] = 0
+            s['failed'] = 0
+            for r in cleaningresult:
+                debug(r['infostring'])
+                if r['dropped']:
+                    s['dropped']+= 1
+                elif r['status'] == 'DROP FAILED':
+                    s['failed']+= 1
+            try:
+                snapindex = snap.snapindex()
+                s['snapshots'] = len(snapindex)
+                s['uniquebytes'] = sum([max(int(x.space_unique), 0) for x in snapindex])
+                if len(snapindex) > 1:
+                    # Unique space of the previous snapshot is about the amount of data changed by the backup
+                    s['previousuniquebytes'] = int(snapindex[-2].space_unique)
+            except Exception as detail:
+                debug("Reading snapshot sizes failed: %s" % detail)
     #
     info("Dump additional information about the environment to the log file")
-    if gimanaged:
-        p = Popen([os.path.join(scriptpath, 'dbinfo.py'), configsection], stdout=PIPE, stderr=None, stdin=None)
-        output,outerr = p.communicate()
-        debug(output)
-    # Write ORACLE_HOME patch information to log file
-    p = Popen([os.path.join(Configuration.get('oraclehome', 'generic'), 'OPatch', 'opatch'), 'lsinventory'], stdout=PIPE, stderr=None, stdin=None)
-    output,outerr = p.communicate()
-    debug(output)    
+    with trace.span('environment dump'):
+        for name, c in envcommands:
+            with trace.span(name) as s:
+                output = c.result()
+                s.update({'returncode': c.returncode, 'bytesread': len(output), 'cached': c.cached})
+            debug("Output of %s (%s, md5 %s):" % (" ".join(c.command), 'cached' if c.cached else "exit code %d" % c.returncode, c.digest()))
+            debug(output)
     #
     info("Write database parameters for autorestore")
-    with open(restoreparamfile, 'w') as f:
-        f.write("[dbparams]\n")
-        output = exec_sqlplus(rmantemplateconfig.get('autorestoreparameters'), silent=True)
-        for line in output.splitlines():
-            if line.startswith('dbconfig-'):
-                f.write("%s\n" % line[9:])
+    with trace.span('parameter export') as s:
+        with open(restoreparamfile, 'w') as f:
+            f.write("[dbparams]\n")
+            for line in probes['autorestoreparameters']:
+                if line.startswith('dbconfig-'):
+                    f.write("%s\n" % line[9:])
+        s['byteswritten'] = os.path.getsize(restoreparamfile)
     #
     endtime = datetime.now()
     info("------------ TOTAL ------------")
     info("Total execution time: %s" % (endtime-starttime))
     info("Execution started: %s" % starttime)
     info("Execution finished: %s" % endtime)
+    debug("Phase trace: %s" % trace.tracefile)
+
+def run_metrics():
+    # Phase durations and numeric phase attributes for the metrics store
+    values = {}
+    for span in trace.spans():
+        key = span['name'].replace(' ', '_')
+        values["%s_seconds" % key] = span.get('seconds')
+        for attribute, value in span['attributes'].iteritems():
+            if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                values["%s_%s" % (key, attribute)] = value
+        rmanbytes = sum([child['attributes'].get('bytes', 0) for child in span['spans'] if child['name'] == 'rman'])
+        if rmanbytes > 0 and span.get('seconds'):
+            values["%s_bytes" % key] = rmanbytes
+            values["%s_mbps" % key] = rmanbytes / 1048576.0 / span['seconds']
+    return values
 
-def exec_template(template_name):
+def exec_template(*template_names):
     rmanscript = ''
     if registercatalog:
         rmanscript+= "%s\n" % rmantemplateconfig.get('resynccatalog')
-    rmanscript+= rmantemplateconfig.get(template_name)
+    rmanscript+= "\n".join([rmantemplateconfig.get(template_name) for template_name in template_names])
     exec_rman(rmanscript)
 
 def generate_restore():
@@ -268,6 +504,8 @@ info("Configuration file: %s" % Configuration.configfilename)
 
 lock = BackupLock(lockdir=backupdest, maxlockwait=int(Configuration.get('maxlockwait', 'generic')))
 
+runstart = datetime.now()
+runsuccess = False
 try:
   # User interface action execution
     if scriptaction == 'config':
@@ -280,10 +518,21 @@ try:
         setschedule()
     elif scriptaction == 'missingarchlog':
         backup_missing_archlog()
+    elif scriptaction == 'backupimagecopy':
+        exec_template('backupimagecopy', 'backupimagecopyfinish')
     else:
         exec_template(scriptaction)
+    runsuccess = True
 finally:
     lock.release()
+    oraexec.closesession()
+    # Collecting metrics must never hide the actual error
+    try:
+        runvalues = run_metrics()
+        runvalues['duration_seconds'] = (datetime.now() - runstart).total_seconds()
+        record_run('backup', configsection, scriptaction, runstart, runsuccess, runvalues)
+    except Exception as detail:
+        debug("Collecting run metrics failed: %s" % detail)
     if (os.getenv('BACKUP_LOG_TO_SCREEN')) and (os.environ['BACKUP_LOG_TO_SCREEN'] == 'TRUE'):
         BackupLogger.close(True)
         print "\n\n======================\nBACKUP LOG FILE OUTPUT\n======================\n\n"
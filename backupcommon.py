@@ -1,7 +1,11 @@
-import os, logging, sys
+import os, logging, sys, glob, hashlib, operator, json
+from copy import deepcopy
+from contextlib import contextmanager
+from bisect import bisect_left, bisect_right
 from tempfile import mkstemp, TemporaryFile
 from datetime import datetime, timedelta
 from time import sleep
+from multiprocessing.dummy import Pool as ThreadPool
 from subprocess import Popen, PIPE
 from abc import ABCMeta, abstractmethod
 from ConfigParser import SafeConfigParser
@@ -56,11 +60,18 @@ class Configuration:
     _config = None
     substitutions = {}
     defaultsection = None
-    _defaults = {'registercatalog': 'false', 'hasdataguard': 'false',
+    _defaults = {'registercatalog': 'false', 'hasdataguard': 'false', 'dataguardmaxwait': '60',
                  'dosnapshot': 'true', 'gimanaged': 'true',
                  'schedulebackup': 'FREQ=DAILY', 'schedulearchlog': 'FREQ=HOURLY;INTERVAL=6',
                  'snapexpirationmonths': 0, 'backupjobenabled': 'true', 'sectionsize': '',
-                 'pga_size': '1G', 'sga_size': '2G', 'backupdestshared': 'true'}
+                 'pga_size': '1G', 'sga_size': '2G', 'backupdestshared': 'true', 'snapcachettl': '0',
+                 'snapdropparallel': '4', 'sqlplussession': 'false',
+                 'rmanmonitor': 'false', 'rmanmonitorinterval': '60',
+                 'longopsmonitor': 'false', 'longopsinterval': '60',
+                 'metricsdb': 'metrics.db', 'logindexdb': 'logindex.db',
+                 'envcachedir': 'envcache', 'envcachemaxage': '24',
+                 'rmanautotune': 'off', 'autotunemaxparallel': '8',
+                 'racchannels': 'false', 'racinstancetns': '${instance}', 'standbytns': ''}
 
     @classmethod
     def getconfigname(cls):
@@ -167,19 +178,126 @@ class BackupLogger:
                 cls.log.removeHandler(handler)
 
     @classmethod
-    def clean(cls):
+    def clean(cls, logdir=None):
+        # logdir can be given when the cleanup is done by a process that does not log to that directory
         if not cls._cleaned:
+            logdir = logdir or cls._logdir
             retentiondays = int(Configuration.get('logretention', 'generic'))
             # Clear old logfiles
-            for fname in os.listdir(cls._logdir):
-                if fname[-4:] == ".log":
-                    fullpath = os.path.join(cls._logdir, fname)
+            for fname in os.listdir(logdir):
+                if fname[-4:] == ".log" or fname[-11:] == ".trace.json":
+                    fullpath = os.path.join(logdir, fname)
                     if os.path.isfile(fullpath) and ( datetime.now() - datetime.fromtimestamp(os.path.getmtime(fullpath)) > timedelta(days=retentiondays) ):
                         if cls.log is not None:
                             cls.log.debug("Removing log: %s" % fullpath)
                         os.remove(fullpath)
             cls._cleaned = True
 
+class PhaseTrace(object):
+    # Collects nested timing spans of one script run and writes them to a JSON trace file
+    # The file is rewritten every time a span ends, so a failed run also leaves a trace
+
+    def __init__(self, tracefile):
+        self.tracefile = tracefile
+        self._root = {'name': 'root', 'start': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'spans': []}
+        self._stack = [self._root]
+
+    @contextmanager
+    def span(self, name, **attributes):
+        # Yields attributes dictionary, where the caller can add exit codes, byte counts etc
+        s = {'name': name, 'start': datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'), 'attributes': attributes, 'spans': []}
+        self._stack[-1]['spans'].append(s)
+        self._stack.append(s)
+        starttime = datetime.now()
+        s['status'] = 'failed'
+        try:
+            yield attributes
+            s['status'] = 'ok'
+        finally:
+            s['seconds'] = round((datetime.now() - starttime).total_seconds(), 3)
+            self._stack.pop()
+            self.write()
+
+    def spans(self):
+        # Top level spans
+        return self._root['spans']
+
+    def write(self):
+        try:
+            with open(self.tracefile, 'w') as f:
+                json.dump(self._root, f, indent=2, sort_keys=True)
+        except IOError as detail:
+            debug("Writing trace file %s failed: %s" % (self.tracefile, detail))
+
+class CachedCommand(object):
+    # Runs a slow informational command in the background, output is cached until
+    # any of the state files changes or the cached output gets older than maxage
+
+    def __init__(self, command, statefiles, cachedir, maxage):
+        self.command = command
+        self.cached = False
+        self.returncode = None
+        self.output = None
+        self._cachedir = cachedir
+        self._maxage = maxage
+        self._process = None
+        self._tmpfile = None
+        state = [os.path.getmtime(f) for f in statefiles if os.path.exists(f)]
+        self._cachefile = os.path.join(cachedir, "%s.out" % hashlib.md5(repr((command, max(state) if state else None))).hexdigest())
+
+    def start(self):
+        if self._maxage > timedelta(0):
+            try:
+                if datetime.now() - datetime.fromtimestamp(os.path.getmtime(self._cachefile)) < self._maxage:
+                    with open(self._cachefile, 'r') as f:
+                        self.output = f.read()
+                    self.cached = True
+                    self.returncode = 0
+                    return
+            except (OSError, IOError):
+                pass
+        # Output goes to a file, so the command would not block on a full pipe while nobody reads it
+        self._tmpfile = TemporaryFile()
+        try:
+            self._process = Popen(self.command, stdout=self._tmpfile, stderr=None, stdin=None)
+        except OSError as detail:
+            # Informational command must never stop the backup
+            self._tmpfile.close()
+            self._tmpfile = None
+            self.output = "Starting %s failed: %s\n" % (self.command[0], detail)
+            self.returncode = -1
+
+    def result(self):
+        # Waits for the command to finish and returns its output
+        if self._process is not None:
+            self.returncode = self._process.wait()
+            self._tmpfile.seek(0,0)
+            self.output = self._tmpfile.read()
+            self._tmpfile.close()
+            self._process = None
+            if self.returncode == 0 and self._maxage > timedelta(0):
+                self._put()
+        return self.output
+
+    def _put(self):
+        try:
+            if not os.path.isdir(self._cachedir):
+                os.makedirs(self._cachedir)
+            tmpf, tmpfilename = mkstemp(suffix='.tmp', dir=self._cachedir)
+            with os.fdopen(tmpf, 'w') as f:
+                f.write(self.output)
+            os.rename(tmpfilename, self._cachefile)
+            # Entries for old states are not used anymore
+            for filename in glob.glob(os.path.join(self._cachedir, "*.out")):
+                if datetime.now() - datetime.fromtimestamp(os.path.getmtime(filename)) > self._maxage:
+                    os.remove(filename)
+        except (OSError, IOError) as detail:
+            debug("Writing command output cache to %s failed: %s" % (self._cachedir, detail))
+
+    def digest(self):
+        # Short content hash for the log, so changes in the output are easy to spot
+        return hashlib.md5(self.output or '').hexdigest()[:12]
+
 class BackupLock(object):
 
     def _createlock(self):
@@ -194,8 +312,8 @@ class BackupLock(object):
             info("Locked! File %s exists." % self._lockfile)
             return False
 
-    def __init__(self, lockdir, maxlockwait=30):
-        self._lockfile = os.path.join(lockdir, 'backup.lck')
+    def __init__(self, lockdir, maxlockwait=30, lockname='backup.lck'):
+        self._lockfile = os.path.join(lockdir, lockname)
         tmpf,self._tmplockfile = mkstemp(suffix='.lck', dir=lockdir)
         # Add here some more useful information about the locker
         os.write(tmpf, "%s\n%s\n%d" % (os.uname(), datetime.now().strftime('%Y-%m-%d %H:%M:%S'), os.getpid()) )
@@ -219,13 +337,115 @@ class BackupLock(object):
         if os.path.exists(self._tmplockfile):
             os.remove(self._tmplockfile)
 
+class SnapCache(object):
+    # Memoizes snapshot listings of one storage handler for ttl seconds within this process
+
+    def __init__(self, ttl):
+        self._ttl = timedelta(seconds=ttl)
+        self._entries = {}
+
+    def get(self, key):
+        # Returns (found, value)
+        if key in self._entries:
+            created, value = self._entries[key]
+            if datetime.now() - created < self._ttl:
+                return (True, value)
+        return (False, None)
+
+    def put(self, key, value):
+        self._entries[key] = (datetime.now(), value)
+
+    def invalidate(self):
+        self._entries = {}
+
+    def cached(self, methodname, method):
+        # Callers get their own copy of the records, so changing them does not change the cached listing
+        def wrapper(*args, **kwargs):
+            key = (methodname, args, tuple(sorted(kwargs.items())))
+            found, value = self.get(key)
+            if not found:
+                value = list(method(*args, **kwargs))
+                self.put(key, value)
+            return deepcopy(value)
+        return wrapper
+
+    def invalidating(self, method):
+        def wrapper(*args, **kwargs):
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.invalidate()
+        return wrapper
+
+class SnapInfo(object):
+    # Compact snapshot information record, the same fields as in dict returned by SnapHandler.getsnapinfo
+    __slots__ = ['id', 'creation', 'numclones', 'space_total', 'space_unique']
+
+    def __init__(self, id, creation, numclones, space_total, space_unique):
+        self.id = id
+        self.creation = creation
+        self.numclones = numclones
+        self.space_total = space_total
+        self.space_unique = space_unique
+
+    @classmethod
+    def fromdict(cls, s):
+        return cls(s["id"], s["creation"], s["numclones"], s["space_total"], s["space_unique"])
+
+    def __getitem__(self, key):
+        # Allows using the record where getsnapinfo dict is expected
+        return getattr(self, key)
+
+class SnapIndex(object):
+    # SnapInfo records sorted by creation time (UTC), lookups use binary search
+
+    def __init__(self, snaps):
+        # Time zone is dropped from the keys the same way as from the lookup arguments, some storage classes return aware creation times
+        self._snaps = sorted(snaps, key=lambda s: s.creation.replace(tzinfo=None))
+        self._keys = [s.creation.replace(tzinfo=None) for s in self._snaps]
+
+    def __len__(self):
+        return len(self._snaps)
+
+    def __iter__(self):
+        return iter(self._snaps)
+
+    def __getitem__(self, idx):
+        return self._snaps[idx]
+
+    def latest(self):
+        return self._snaps[-1] if self._snaps else None
+
+    def latest_before(self, t):
+        # The latest snapshot created at or before t
+        idx = bisect_right(self._keys, t.replace(tzinfo=None))
+        return self._snaps[idx-1] if idx > 0 else None
+
+    def latest_older_than(self, age):
+        # The latest snapshot that is at least age (timedelta) old
+        return self.latest_before(datetime.utcnow() - age)
+
+    def first_after(self, t):
+        # The first snapshot created at or after t
+        idx = bisect_left(self._keys, t.replace(tzinfo=None))
+        return self._snaps[idx] if idx < len(self._snaps) else None
+
 class SnapHandler(object):
     __metaclass__ = ABCMeta
     configname = None
+    _cache = None
 
     @abstractmethod
     def __init__(self, configname):
         self.configname = configname
+        # Snapshot listing can be cached, operations that change snapshots or clones clear the cache
+        # Clone listings are not cached, they are paged lazily by some storage classes
+        ttl = int(Configuration.get('snapcachettl', 'generic'))
+        if ttl > 0:
+            self._cache = SnapCache(ttl)
+            self.listsnapshots = self._cache.cached('listsnapshots', self.listsnapshots)
+            for methodname in ['snap', 'dropsnap', 'dropsnaps', 'clone', 'dropclone']:
+                setattr(self, methodname, self._cache.invalidating(getattr(self, methodname)))
 
     @abstractmethod
     def listsnapshots(self, sortbycreation=False, sortreverse=False):
@@ -246,6 +466,10 @@ class SnapHandler(object):
         # Must return dict with elements id (string), creation (with type datetime in UTC), numclones (int), space_total (int in bytes), space_unique (int in bytes)
         pass
 
+    def snapindex(self):
+        # Creation sorted index of all snapshots
+        return SnapIndex([SnapInfo.fromdict(self.getsnapinfo(s)) for s in self.listsnapshots()])
+
     def snap2str(self, s):
         # Convert the snap information to one nice string value
         # Input must come from getsnapinfo
@@ -291,77 +515,99 @@ class SnapHandler(object):
         # Creates new volume for storing backups
         pass
 
-    def clean(self):
+    def retentionplan(self):
+        # Decides in one pass over the creation sorted snapshots which snapshots can be dropped
         max_age_days = int(Configuration.get('snapexpirationdays'))
         max_age_months = int(Configuration.get('snapexpirationmonths'))
-        sorted_snaps = self.listsnapshots(sortbycreation=True)
-        output = []
-        number_of_snaps = len(sorted_snaps)
-        for idx, snapstruct in enumerate(sorted_snaps):
-          s = self.getsnapinfo(snapstruct)
-          d = s["creation"]
-          age = datetime.utcnow() - d
+        now = datetime.utcnow()
+        index = self.snapindex()
+        plan = []
+        for idx, s in enumerate(index):
+          age = now - s.creation
           status = "valid"
           drop_allowed = False
-          dropped = False
           # Check snap expiration
           if age > timedelta(days=max_age_days):
             if age > timedelta(days=max_age_months*31):
               # Drop is allowed if monthly expiration has also passed
               drop_allowed = True
-            else:
-              if idx+1 < number_of_snaps:
-                # The last snap of each month is retained
-                previnfo = self.getsnapinfo(sorted_snaps[idx+1])
-                drop_allowed = str(s["creation"])[0:7] == str(previnfo["creation"])[0:7]
-          if drop_allowed and s["numclones"] != 0:
+            elif idx+1 < len(index):
+              # The last snap of each month is retained
+              nextcreation = index[idx+1].creation
+              drop_allowed = (s.creation.year, s.creation.month) == (nextcreation.year, nextcreation.month)
+          if drop_allowed and s.numclones != 0:
             status = "has a clone"
             drop_allowed = False
-          # Do the actual drop
-          if drop_allowed:
+          plan.append({'snap': s, 'drop': drop_allowed, 'status': status})
+        return plan
+
+    def dropsnaps(self, snapids):
+        # Drops a list of snapshots using a bounded number of parallel calls
+        # Returns the set of snapshot ids that failed to drop
+        # Storage classes that have a bulk delete API can override this
+        failed = set()
+        def drop(snapid):
+            try:
+                self.dropsnap(snapid)
+            except Exception as detail:
+                debug("Dropping snapshot %s failed: %s" % (snapid, detail))
+                failed.add(snapid)
+        workers = min(int(Configuration.get('snapdropparallel', 'generic')), len(snapids))
+        if workers > 1:
+            pool = ThreadPool(workers)
             try:
-              self.dropsnap(s["id"])
+                pool.map(drop, snapids)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for snapid in snapids:
+                drop(snapid)
+        return failed
+
+    def clean(self, planonly=False):
+        plan = self.retentionplan()
+        todrop = [p['snap'].id for p in plan if p['drop']]
+        if planonly:
+            failed = set(todrop)
+        elif len(todrop) > 0:
+            failed = self.dropsnaps(todrop)
+        for p in plan:
+          s = p['snap']
+          status = p['status']
+          dropped = False
+          if p['drop']:
+            if planonly:
+              status = "to be dropped"
+            elif s.id in failed:
+              status = "DROP FAILED"
+            else:
               dropped = True
               status = "dropped"
-            except:
-              status = "DROP FAILED"
-          yield {'snapid': s["id"], 'dropped': dropped, 'status': status, 'infostring': "%s %s" % (self.snap2str(s), status)}
+          yield {'snapid': s.id, 'dropped': dropped, 'status': status, 'infostring': "%s %s" % (self.snap2str(s), status)}
 
-    def autoclone(self):
+    def autoclone(self, clonename=None):
         # Returns source snap id
         maxsnapage = timedelta(hours = int(Configuration.get('autorestoresnapage', 'autorestore')), minutes=0 )
-        # Find the snap for cloning
-        sorted_snaps = self.listsnapshots(sortbycreation=True, sortreverse=True)
-        sourcesnap = None
-        for idx, snaprecord in enumerate(sorted_snaps):
-            s = self.getsnapinfo(snaprecord)
-            d = s["creation"]
-            age = datetime.utcnow() - d
-            if age >= maxsnapage:
-                sourcesnap = s["id"]
-                break
-        if sourcesnap is None:
+        # Find the latest snap that is old enough for cloning
+        s = self.snapindex().latest_older_than(maxsnapage)
+        if s is None:
             raise Exception('snap','Suitable snapshot not found for cloning.')
         else:
+            sourcesnap = s.id
             # Clone the snap
             debug("Snapshot id for autoclone: %s" % sourcesnap)
-            self.clone(sourcesnap, Configuration.get('autorestoreclonename', 'autorestore'))
+            self.clone(sourcesnap, clonename if clonename is not None else Configuration.get('autorestoreclonename', 'autorestore'))
             return sourcesnap
 
-    def dropautoclone(self):
-        self.dropclone(Configuration.get('autorestoreclonename', 'autorestore'))
+    def dropautoclone(self, clonename=None):
+        self.dropclone(clonename if clonename is not None else Configuration.get('autorestoreclonename', 'autorestore'))
 
     # Finds the correct snapshot to clone based on restore target time
     # Targettime must be in UTC
     def search_recovery_snapid(self, targettime):
-        sorted_snaps = self.listsnapshots(sortbycreation=True, sortreverse=False)
-        sourcesnap = None
-        for idx, snaprecord in enumerate(sorted_snaps):
-            s = self.getsnapinfo(snaprecord)
-            if s['creation'].replace(tzinfo=None) >= targettime.replace(tzinfo=None):
-                sourcesnap = s['id']
-                break
-        return sourcesnap
+        s = self.snapindex().first_after(targettime)
+        return s.id if s is not None else None
 
 # Class for outputting some UI elements, like prompts
 class UIElement(object):
@@ -1,7 +1,10 @@
 #!/usr/bin/python2
 
 import os, sys
-from subprocess import check_call
+from datetime import datetime
+from subprocess import Popen, STDOUT
+from tempfile import TemporaryFile
+from time import sleep
 from backupcommon import scriptpath, Configuration
 
 def printhelp():
@@ -16,7 +19,7 @@ scriptpath = scriptpath()
 
 # Read configuration
 configsection = sys.argv[1]
-Configuration.init()
+Configuration.init(additionaldefaults={'execallworkers': '1', 'execallmaxperstorage': '0'})
 
 if len(sys.argv) == 3:
   excludelist = sys.argv[2].split(",")
@@ -27,10 +30,86 @@ excludelist.append('rman')
 excludelist.append('zfssa')
 excludelist.append('autorestore')
 excludelist.append('netapp')
+excludelist.append('softnas')
+excludelist.append('huaweidorado')
 
-# Loop through all sections
+# Storage module name mapped to configuration section and the parameter that identifies the storage head
+storagesections = {'zfssa': ('zfssa', 'url'), 'netapp': ('netapp', 'filer'), 'softnas': ('softnas', 'serveraddress'), 'huawei': ('huaweidorado', 'url')}
+
+def storagehead(dbname):
+  # Returns the storage section and the identifier of the storage head the database is backed up to
+  Configuration.defaultsection = dbname
+  module = Configuration.get('snappermodule', 'generic')
+  section, parameter = storagesections.get(module, (module, None))
+  try:
+    head = Configuration.get(parameter, section)
+  except:
+    head = module
+  return (section, "%s:%s" % (module, head))
+
+def maxperstorage(section):
+  # Concurrency limit for one storage head, 0 means no limit
+  try:
+    return int(Configuration.get('maxparallel', section))
+  except:
+    return int(Configuration.get('execallmaxperstorage', 'generic'))
+
+workers = max(1, int(Configuration.get('execallworkers', 'generic')))
+
+# Build the queue of databases to process
+queue = []
 for dbname in Configuration.sections():
   if dbname not in excludelist:
-    # Execute backup.py with the specified action
-    print "--- DATABASE: %s ---" % dbname
-    check_call([ os.path.join(scriptpath, 'backup.py'), dbname, configsection])
+    section, head = storagehead(dbname)
+    queue.append({'dbname': dbname, 'head': head, 'limit': maxperstorage(section)})
+
+def startjob(job):
+  if workers == 1:
+    print "--- DATABASE: %s ---" % job['dbname']
+    job['output'] = None
+  else:
+    # In parallel mode collect the output of each database separately, so it would not get mixed up
+    job['output'] = TemporaryFile()
+  job['start'] = datetime.now()
+  job['process'] = Popen([os.path.join(scriptpath, 'backup.py'), job['dbname'], configsection], stdout=job['output'], stderr=STDOUT if job['output'] else None)
+
+def finishjob(job):
+  job['end'] = datetime.now()
+  job['returncode'] = job['process'].returncode
+  if job['output'] is not None:
+    print "--- DATABASE: %s ---" % job['dbname']
+    job['output'].seek(0,0)
+    for line in job['output']:
+      sys.stdout.write(line)
+    job['output'].close()
+  sys.stdout.flush()
+
+# Loop through all sections, starting new backups whenever a worker and the storage head are free
+running = []
+finished = []
+while queue or running:
+  for job in running[:]:
+    if job['process'].poll() is not None:
+      running.remove(job)
+      finishjob(job)
+      finished.append(job)
+  for job in queue[:]:
+    if len(running) >= workers:
+      break
+    onhead = len([r for r in running if r['head'] == job['head']])
+    if job['limit'] > 0 and onhead >= job['limit']:
+      continue
+    queue.remove(job)
+    startjob(job)
+    running.append(job)
+  if running:
+    sleep(1)
+
+# Summary
+exitstatus = 0
+print "--- SUMMARY: %s ---" % configsection
+for job in finished:
+  if job['returncode'] != 0:
+    exitstatus = 1
+  print "%-20s exit code: %-4d duration: %s" % (job['dbname'], job['returncode'], job['end']-job['start'])
+sys.exit(exitstatus)
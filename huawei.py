@@ -136,35 +136,60 @@ class HuaweiDorado(SnapHandler):
         return snapname
 
     def dropsnap(self, snapid):
-        for snap in self.listsnapshots():
+        for snap in self._snapshots(countclones=False):
             if snap['id'] == snapid:
                 r = self._http.delete("fssnapshot/%s" % snap['internal_id'])
                 break
 
-    def _getclones(self, snapname=None):
-        clones = []
+    def dropsnaps(self, snapids):
+        # Internal ids are looked up from one snapshot listing, deletes are sent serially since the login session is shared
+        failed = set()
+        try:
+            internalids = dict((snap['id'], snap['internal_id']) for snap in self._snapshots(countclones=False))
+        except Exception as detail:
+            debug("Listing snapshots for drop failed: %s" % detail)
+            return set(snapids)
+        for snapid in snapids:
+            try:
+                if snapid in internalids:
+                    self._http.delete("fssnapshot/%s" % internalids[snapid])
+            except Exception as detail:
+                debug("Dropping snapshot %s failed: %s" % (snapid, detail))
+                failed.add(snapid)
+        return failed
+
+    def _clonefilesystems(self, snapname=None):
+        # Lists clones of the backup filesystem from a single filesystem listing
         # DIDN't WORK: 'filter': "ISCLONEFS:true"
         r = self._http.get("filesystem", payload={'vstoreId': self._vstoreid()})
         for rx in r['data']:
             if rx['ISCLONEFS'] == 'true' and rx['PARENTFILESYSTEMNAME'].upper() == self._filesystem.upper() and (snapname is None or rx['PARENTSNAPSHOTNAME'].upper() == snapname.upper()):
-                clones.append({'internal_id': rx['ID'], 'clonename': rx['NAME'], 'origin': rx['PARENTSNAPSHOTNAME'], 'mountpoint': self._get_share(rx['NAME'])['path']})
+                yield rx
+
+    def _getclones(self, snapname=None):
+        clones = []
+        for rx in self._clonefilesystems(snapname):
+            clones.append({'internal_id': rx['ID'], 'clonename': rx['NAME'], 'origin': rx['PARENTSNAPSHOTNAME'], 'mountpoint': self._get_share(fid=rx['ID'])['path']})
         return clones
 
     def getsnapinfo(self, snapstruct):
-        #r = self._http.get("fssnapshot/%s" % snapstruct['internal_id'], payload={'vstoreid': self._vstoreid()})
-        #s = r['data']
-        #print(s)
-        clones = self._getclones(snapstruct['id'])
+        # Number of clones is already counted by listsnapshots
         return {
             'id': snapstruct['id'],
             'intrnal_id': snapstruct['internal_id'],
             'creation': snapstruct['creation'],
-            'numclones': len(clones),
+            'numclones': snapstruct['numclones'],
             'space_total': snapstruct['space_total'], # Not supported yet by huawei
             'space_unique': snapstruct['space_unique'] # Not supported yet by huawei
         }
 
-    def listsnapshots(self, sortbycreation=False, sortreverse=False):
+    def _snapshots(self, countclones=True):
+        # Clone counts for all snapshots are computed from one filesystem listing
+        numclones = {}
+        if countclones:
+            for rx in self._clonefilesystems():
+                parent = rx['PARENTSNAPSHOTNAME'].upper()
+                numclones[parent] = numclones.get(parent, 0) + 1
         r = self._http.get("fssnapshot", payload={'PARENTID': self._fsid()})
         #pp.pprint(r.json())
         snaps = []
@@ -173,16 +198,21 @@ class HuaweiDorado(SnapHandler):
                 'id': snap['NAME'],
                 'internal_id': snap['ID'],
                 'creation': datetime.utcfromtimestamp(int(snap['utcTimeStamp'])),
-                'numclones': 0, # Need to make an extra call
+                'numclones': numclones.get(snap['NAME'].upper(), 0),
                 'space_total': -1,'space_unique': -1 # Not supported yet by Huawei
             })
+        return snaps
+
+    def listsnapshots(self, sortbycreation=False, sortreverse=False):
+        snaps = self._snapshots()
         if not sortbycreation:
             return snaps
         else:
             return sorted(snaps, key=operator.itemgetter('creation'), reverse=sortreverse)
 
-    def _get_share(self, filesystemname=None):
-        fid = self._fsid(filesystemname)
+    def _get_share(self, filesystemname=None, fid=None):
+        if fid is None:
+            fid = self._fsid(filesystemname)
         if fid is None:
             raise Exception(self._exceptionbase, "Can't find filesystem")
         r = self._http.get("NFSHARE", payload={'vstoreId': self._vstoreid(), 'filter': "FSID:%s" % fid})
@@ -203,7 +233,7 @@ class HuaweiDorado(SnapHandler):
 
     def clone(self, snapid, clonename):
         snap_internal_id = None
-        for snap in self.listsnapshots():
+        for snap in self._snapshots(countclones=False):
             if snap['id'] == snapid:
                 snap_internal_id = snap['internal_id']
                 break
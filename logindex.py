@@ -0,0 +1,179 @@
+#!/usr/bin/python2
+
+import os, sys, re, mmap, sqlite3, glob
+from datetime import datetime
+from backupcommon import scriptpath, Configuration
+
+class LogParser(object):
+    # Extracts events from one backup or autorestore session log
+    _logline = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),\d+ \w+\s+(\S+)\s+(.*)$')
+    _sqlelapsed = re.compile(r'^Elapsed: (\d+):(\d+):(\d+(?:\.\d+)?)')
+    _rmantime = re.compile(r'^RMAN execution time (?:(\d+) days?, )?(\d+):(\d+):(\d+(?:\.\d+)?)')
+    _channelline = re.compile(r'^channel (\S+): (.*)$')
+    _elapsed = re.compile(r'elapsed time: (\d+):(\d+):(\d+)')
+    _datafile = re.compile(r'^(?:input datafile|recovering datafile copy) file number=(\d+) name=(\S+)')
+    _error = re.compile(r'\b((?:RMAN|ORA)-\d{5})')
+
+    def __init__(self, defaulttime):
+        self._time = defaulttime
+        self._dbname = None
+        self._lastchannel = None
+        self._channelfiles = {}
+        self._channelstep = {}
+        self.events = []
+
+    def _event(self, kind, seconds=None, channel=None, datafile=None, code=None, text=None):
+        self.events.append((self._time, self._dbname, kind, seconds, channel, datafile, code, text))
+
+    def parse(self, line):
+        m = self._logline.match(line)
+        if m:
+            # Lines written by the scripts themselves carry the timestamp and database name, RMAN and SQL*Plus lines don't
+            self._time = m.group(1)
+            self._dbname = m.group(2)
+            line = m.group(3)
+            m = self._rmantime.match(line)
+            if m:
+                days, hours, minutes, seconds = m.groups()
+                self._event('rmantime', seconds=int(days or 0)*86400 + int(hours)*3600 + int(minutes)*60 + float(seconds))
+        m = self._sqlelapsed.match(line)
+        if m:
+            self._event('sqlelapsed', seconds=int(m.group(1))*3600 + int(m.group(2))*60 + float(m.group(3)))
+            return
+        m = self._channelline.match(line)
+        if m:
+            channel, message = m.groups()
+            self._lastchannel = channel
+            if message.startswith('starting') and not message.startswith('starting piece'):
+                self._channelstep[channel] = message
+                self._channelfiles[channel] = []
+            e = self._elapsed.search(message)
+            if e:
+                seconds = int(e.group(1))*3600 + int(e.group(2))*60 + int(e.group(3))
+                self._event('channelstep', seconds=seconds, channel=channel, text=self._channelstep.get(channel))
+                # All datafiles of the backup set or copy get the elapsed time of the whole step
+                for datafile in self._channelfiles.get(channel, []):
+                    self._event('datafile', seconds=seconds, channel=channel, datafile=datafile, text=self._channelstep.get(channel))
+                self._channelfiles[channel] = []
+        else:
+            m = self._datafile.match(line)
+            if m and self._lastchannel is not None:
+                # Datafile lines follow the channel line that started the step
+                self._channelfiles.setdefault(self._lastchannel, []).append(m.group(2))
+        for code in set(self._error.findall(line)):
+            self._event('error', code=code, text=line[:500])
+
+class LogIndex(object):
+    # Compact SQLite index of events extracted from session logs
+    # Only new or changed log files are parsed, logs are read through mmap
+    _schema = ["create table if not exists files (id integer primary key autoincrement, path text unique not null, size integer not null, mtime real not null)",
+               "create table if not exists events (fileid integer not null references files(id), time text, dbname text, kind text not null, seconds real, channel text, datafile text, code text, text text)",
+               "create index if not exists events_kind on events (kind, time)",
+               "create index if not exists events_file on events (fileid)"]
+
+    def __init__(self, dbfile):
+        self._conn = sqlite3.connect(dbfile, timeout=60)
+        with self._conn:
+            for ddl in self._schema:
+                self._conn.execute(ddl)
+
+    def _indexfile(self, path, size, mtime):
+        parser = LogParser(datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S'))
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for line in iter(mm.readline, ''):
+                    parser.parse(line.rstrip())
+            finally:
+                mm.close()
+        with self._conn:
+            row = self._conn.execute("select id from files where path = ?", (path,)).fetchone()
+            if row is not None:
+                # Changed file is indexed again from the beginning
+                self._conn.execute("delete from events where fileid = ?", (row[0],))
+                self._conn.execute("update files set size = ?, mtime = ? where id = ?", (size, mtime, row[0]))
+                fileid = row[0]
+            else:
+                fileid = self._conn.execute("insert into files (path, size, mtime) values (?,?,?)", (path, size, mtime)).lastrowid
+            self._conn.executemany("insert into events (fileid, time, dbname, kind, seconds, channel, datafile, code, text) values (?,?,?,?,?,?,?,?,?)",
+                [(fileid,) + e for e in parser.events])
+        return len(parser.events)
+
+    def _removemissing(self, known):
+        # Logs removed by BackupLogger.clean are removed from the index too
+        missing = [path for path in known if not os.path.isfile(path)]
+        with self._conn:
+            for path in missing:
+                self._conn.execute("delete from events where fileid = (select id from files where path = ?)", (path,))
+                self._conn.execute("delete from files where path = ?", (path,))
+        return len(missing)
+
+    def update(self, directories):
+        # Returns tuple (number of indexed files, number of new events, number of removed files)
+        known = dict((path, (size, mtime)) for path, size, mtime in self._conn.execute("select path, size, mtime from files"))
+        removed = self._removemissing(known)
+        files = 0
+        events = 0
+        for directory in directories:
+            for path in glob.glob(os.path.join(directory, '*.log')):
+                st = os.stat(path)
+                if st.st_size == 0 or known.get(path) == (st.st_size, st.st_mtime):
+                    continue
+                files += 1
+                events += self._indexfile(path, st.st_size, st.st_mtime)
+        return (files, events, removed)
+
+    def query(self, sql, params=()):
+        return self._conn.execute(sql, params).fetchall()
+
+    def close(self):
+        self._conn.close()
+
+def logdirectories():
+    # Backup log directories of all databases and autorestore log directory
+    directories = set()
+    for section in Configuration.sections():
+        if section in ['generic','rman','zfssa','autorestore','netapp','softnas','huaweidorado']:
+            continue
+        Configuration.defaultsection = section
+        if Configuration.get('backupdestshared', 'generic').upper() == 'TRUE':
+            directories.add(os.path.join(Configuration.get('backupdest', 'generic'), section, 'backup_logs'))
+        else:
+            directories.add(os.path.join(Configuration.get('backupdest', 'generic'), 'backup_logs'))
+    try:
+        directories.add(Configuration.get('autorestorelogdir', 'autorestore'))
+    except:
+        pass
+    return [d for d in directories if os.path.isdir(d)]
+
+def printhelp():
+    print "Usage: logindex.py update [directory ...]"
+    print "       logindex.py slowest [days] [limit]"
+    print "       logindex.py errors <error code, for example ORA-19502> [days]"
+    print "       logindex.py rmantimes [database] [days]"
+    sys.exit(2)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in ['update', 'slowest', 'errors', 'rmantimes'] or (sys.argv[1] == 'errors' and len(sys.argv) < 3):
+        printhelp()
+    Configuration.init('generic')
+    index = LogIndex(os.path.join(scriptpath(), Configuration.get('logindexdb', 'generic')))
+    since = "datetime('now', 'localtime', ?)"
+    if sys.argv[1] == 'update':
+        files, events, removed = index.update(sys.argv[2:] if len(sys.argv) > 2 else logdirectories())
+        print "Indexed %d new or changed log files, %d events. Removed %d deleted log files from the index." % (files, events, removed)
+    elif sys.argv[1] == 'slowest':
+        days = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+        limit = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+        for dbname, datafile, seconds, time, step in index.query("select dbname, datafile, max(seconds) s, max(time), text from events where kind = 'datafile' and time >= %s group by dbname, datafile order by s desc limit ?" % since, ("-%d days" % days, limit)):
+            print "%-12s %8ds %s %s (%s)" % (dbname, seconds, time, datafile, step)
+    elif sys.argv[1] == 'errors':
+        days = int(sys.argv[3]) if len(sys.argv) > 3 else 30
+        for time, dbname, path, count in index.query("select min(e.time), e.dbname, f.path, count(*) from events e join files f on f.id = e.fileid where e.kind = 'error' and e.code = ? and e.time >= %s group by f.path, e.dbname order by 1" % since, (sys.argv[2].upper(), "-%d days" % days)):
+            print "%s %-12s %d times %s" % (time, dbname, count, path)
+    else:
+        dbname = sys.argv[2] if len(sys.argv) > 2 else None
+        days = int(sys.argv[3]) if len(sys.argv) > 3 else 30
+        for time, db, seconds, path in index.query("select e.time, e.dbname, e.seconds, f.path from events e join files f on f.id = e.fileid where e.kind = 'rmantime' and e.time >= %s and (? is null or e.dbname = ?) order by e.time" % since, ("-%d days" % days, dbname, dbname)):
+            print "%s %-12s %10.1fs %s" % (time, db, seconds, path)
+    index.close()
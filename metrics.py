@@ -0,0 +1,122 @@
+#!/usr/bin/python2
+
+import os, sys, sqlite3
+from datetime import datetime
+from backupcommon import scriptpath, Configuration, debug
+
+class MetricsStore(object):
+    # Local SQLite database of run metrics from backup.py, autorestore.py and zsnapper.py
+    _timeout = 60 # Seconds to wait for a lock, parallel exec_all.py runs write at the same time
+    _schema = ["create table if not exists runs (id integer primary key autoincrement, tool text not null, dbname text not null, action text not null, starttime text not null, success integer not null)",
+               "create table if not exists metrics (runid integer not null references runs(id), name text not null, value real)",
+               "create index if not exists runs_key on runs (tool, dbname, action, starttime)",
+               "create index if not exists metrics_runid on metrics (runid, name)"]
+
+    def __init__(self, dbfile):
+        self._conn = sqlite3.connect(dbfile, timeout=self._timeout)
+        with self._conn:
+            for ddl in self._schema:
+                self._conn.execute(ddl)
+
+    def record(self, tool, dbname, action, starttime, success, values):
+        # values is a dictionary of metric name and numeric value
+        with self._conn:
+            c = self._conn.execute("insert into runs (tool, dbname, action, starttime, success) values (?,?,?,?,?)",
+                (tool, dbname, action, starttime.strftime('%Y-%m-%d %H:%M:%S'), 1 if success else 0))
+            self._conn.executemany("insert into metrics (runid, name, value) values (?,?,?)",
+                [(c.lastrowid, name, value) for name, value in values.iteritems() if value is not None])
+
+    def series(self, dbname=None, metric=None, days=None):
+        # Returns dictionary (tool, dbname, action, metric) -> list of (starttime, success, value) in time order
+        query = "select r.tool, r.dbname, r.action, m.name, r.starttime, r.success, m.value from runs r join metrics m on m.runid = r.id where 1=1"
+        params = []
+        if dbname is not None:
+            query+= " and r.dbname = ?"
+            params.append(dbname)
+        if metric is not None:
+            query+= " and m.name = ?"
+            params.append(metric)
+        if days is not None:
+            query+= " and r.starttime >= datetime('now', 'localtime', ?)"
+            params.append("-%d days" % days)
+        query+= " order by r.tool, r.dbname, r.action, m.name, r.starttime"
+        result = {}
+        for tool, db, action, name, starttime, success, value in self._conn.execute(query, params):
+            result.setdefault((tool, db, action, name), []).append((starttime, success, value))
+        return result
+
+    def close(self):
+        self._conn.close()
+
+def metricsfile():
+    # Relative path is relative to the script directory
+    return os.path.join(scriptpath(), Configuration.get('metricsdb', 'generic'))
+
+def record_run(tool, dbname, action, starttime, success, values):
+    # Recording metrics must never fail the actual operation
+    if not Configuration.get('metricsdb', 'generic'):
+        return
+    try:
+        store = MetricsStore(metricsfile())
+        try:
+            store.record(tool, dbname, action, starttime, success, values)
+        finally:
+            store.close()
+    except Exception as detail:
+        debug("Recording metrics failed: %s" % detail)
+
+def median(values):
+    s = sorted(values)
+    if len(s) == 0:
+        return None
+    elif len(s) % 2 == 1:
+        return s[len(s)/2]
+    else:
+        return (s[len(s)/2-1] + s[len(s)/2]) / 2.0
+
+def regression(name, value, baseline, factor):
+    # Durations are worse when larger, throughput is worse when smaller, other metrics are not checked
+    if baseline is None or baseline <= 0:
+        return False
+    if name.endswith('seconds'):
+        return value > baseline * factor
+    elif name.endswith('mbps'):
+        return value < baseline / factor
+    return False
+
+def printhelp():
+    print "Usage: metrics.py <trends|regressions> [database] [metric]"
+    sys.exit(2)
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [2,3,4] or sys.argv[1] not in ['trends', 'regressions']:
+        printhelp()
+    Configuration.init('generic', additionaldefaults={'metricswindow': '14', 'metricsregressionfactor': '1.5', 'metricsdays': '60'})
+    if not Configuration.get('metricsdb', 'generic'):
+        print "Metrics store is disabled, set parameter metricsdb in section generic."
+        sys.exit(1)
+    window = int(Configuration.get('metricswindow', 'generic'))
+    factor = float(Configuration.get('metricsregressionfactor', 'generic'))
+    store = MetricsStore(metricsfile())
+    series = store.series(sys.argv[2] if len(sys.argv) > 2 else None, sys.argv[3] if len(sys.argv) > 3 else None, int(Configuration.get('metricsdays', 'generic')))
+    exitcode = 0
+    for key in sorted(series.keys()):
+        tool, dbname, action, name = key
+        values = series[key]
+        if sys.argv[1] == 'trends':
+            print "%s %s %s %s:" % (dbname, tool, action, name)
+            for starttime, success, value in values[-window:]:
+                print "  %s %-7s %14.2f" % (starttime, 'ok' if success else 'FAILED', value)
+            print "  median %27.2f" % median([v[2] for v in values[-window:]])
+        else:
+            # Compare the latest successful run to the rolling median of the successful runs before it
+            successful = [v for v in values if v[1]]
+            if len(successful) < 2:
+                continue
+            starttime, success, value = successful[-1]
+            baseline = median([v[2] for v in successful[-window-1:-1]])
+            if regression(name, value, baseline, factor):
+                exitcode = 1
+                print "%s %s %s %s: %s value %.2f, rolling median %.2f" % (dbname, tool, action, name, starttime, value, baseline)
+    store.close()
+    sys.exit(exitcode)
@@ -1,9 +1,105 @@
-import os, operator
+import os, operator, requests
 from backupcommon import SnapHandler, Configuration, scriptpath, info, error, debug, UIElement
 from ConfigParser import SafeConfigParser, NoOptionError, NoSectionError
 from datetime import datetime, timedelta
 from NaServer import *
 from time import sleep
+from threading import Lock
+from multiprocessing.dummy import Pool as ThreadPool
+from requests.adapters import HTTPAdapter
+from xml.etree import ElementTree
+
+class NetappAdapter(HTTPAdapter):
+    # Connection pool that verifies filer certificate against CA, but not the host name, like NaServer.set_hostname_verification(False)
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['assert_hostname'] = False
+        return super(NetappAdapter, self).init_poolmanager(*args, **kwargs)
+
+class NetappHttp(object):
+    # Sends ZAPI calls over a pooled keep-alive HTTPS session instead of opening a new connection for each NaServer call
+    # Transport settings (protocol, port, timeout, CA certificate) are taken from the configured NaServer object
+    _url = "/servlets/netapp.servlets.admin.XMLrequest_filer"
+
+    def __init__(self, filer, srv, user, password, cacert=None, poolsize=4, version=(1, 1)):
+        self._version = version
+        protocol = srv.get_transport_type().lower()
+        port = srv.get_port()
+        self._baseurl = "%s://%s:%s%s" % (protocol, filer, port, self._url)
+        self._timeout = srv.get_timeout() if srv.get_timeout() else None
+        self._calls = 0
+        self._elapsed = timedelta(0)
+        self._maxelapsed = timedelta(0)
+        # Same transport is used from parallel worker threads
+        self._statslock = Lock()
+        if cacert:
+            adapter = NetappAdapter(pool_connections=1, pool_maxsize=poolsize)
+        else:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolsize)
+            try:
+                requestwarning = __import__('requests.packages.urllib3.exceptions', globals(), locals(), ['InsecureRequestWarning'])
+                requestwarningclass = getattr(requestwarning, 'InsecureRequestWarning')
+                requests.packages.urllib3.disable_warnings(requestwarningclass)
+            except AttributeError:
+                pass
+        self._session = requests.Session()
+        self._session.auth = (user, password)
+        self._session.verify = cacert if cacert else False
+        self._session.headers.update({'Content-Type': 'text/xml; charset="UTF-8"'})
+        self._session.mount("%s://" % protocol, adapter)
+
+    def _fail(self, reason):
+        # Same kind of failed result NaServer returns
+        output = NaElement("results")
+        output.attr_set("status", "failed")
+        output.attr_set("reason", reason)
+        output.attr_set("errno", "13001")
+        return output
+
+    def _toelement(self, node):
+        # Converts parsed XML node to NaElement
+        elem = NaElement(node.tag.split('}')[-1])
+        for key, value in node.attrib.items():
+            elem.attr_set(key, value)
+        children = list(node)
+        for child in children:
+            elem.child_add(self._toelement(child))
+        if not children and node.text is not None:
+            elem.set_content(node.text)
+        return elem
+
+    def stats(self):
+        with self._statslock:
+            return {'calls': self._calls, 'elapsed': self._elapsed, 'max': self._maxelapsed}
+
+    def invoke_elem(self, elem):
+        content = "<?xml version='1.0' encoding='utf-8'?>\n<!DOCTYPE netapp SYSTEM 'file:/etc/netapp_filer.dtd'>\n<netapp version='%d.%d' xmlns='http://www.netapp.com/filer/admin'>%s</netapp>" % (self._version[0], self._version[1], elem.toEncodedString())
+        starttime = datetime.now()
+        try:
+            r = self._session.post(self._baseurl, data=content, timeout=self._timeout)
+        except requests.exceptions.RequestException as e:
+            return self._fail("Connection to filer failed: %s" % e)
+        elapsed = datetime.now() - starttime
+        with self._statslock:
+            self._calls += 1
+            self._elapsed += elapsed
+            self._maxelapsed = max(self._maxelapsed, elapsed)
+        debug("ZAPI call %s took %s" % (elem.element['name'], elapsed))
+        if r.status_code != 200:
+            return self._fail("HTTP call to filer returned %d" % r.status_code)
+        try:
+            root = ElementTree.fromstring(r.content)
+        except Exception as e:
+            return self._fail("Parsing filer response failed: %s" % e)
+        for node in root:
+            if node.tag.split('}')[-1] == 'results':
+                return self._toelement(node)
+        return self._fail("No results in filer response")
+
+    def invoke(self, api, *args):
+        elem = NaElement(api)
+        for i in range(0, len(args)-1, 2):
+            elem.child_add_string(args[i], str(args[i+1]))
+        return self.invoke_elem(elem)
 
 class Netapp(SnapHandler):
     _exceptionbase = "netapp"
@@ -11,6 +107,7 @@ class Netapp(SnapHandler):
     _filer = None
     _cacert = None
     _multivol = False
+    _statetimeout = 300 # Seconds to wait for volume state change
 
     def _read_netapp_config(self, attribute, zfscredconfig):
         # Try reading Netapp configuration first from the credentials file, then fail over to main configuration file
@@ -45,6 +142,18 @@ class Netapp(SnapHandler):
             self._srv.set_hostname_verification(False)
         #
         self._srv.set_admin_user(zfscredconfig.get('netappcredentials','user'), zfscredconfig.get('netappcredentials','password'))
+        # Optional keep-alive transport, uses the same NaServer protocol, port and timeout
+        # It does not support vserver/vfiler tunnelling and does not verify the filer host name
+        try:
+            keepalive = self._read_netapp_config('keepalive', zfscredconfig).upper() == 'TRUE'
+        except:
+            keepalive = False
+        if keepalive:
+            try:
+                poolsize = int(self._read_netapp_config('poolsize', zfscredconfig))
+            except:
+                poolsize = 4
+            self._srv = NetappHttp(self._filer, self._srv, zfscredconfig.get('netappcredentials','user'), zfscredconfig.get('netappcredentials','password'), self._cacert, poolsize)
         try:
             self._mounthost = self._read_netapp_config('mounthost', zfscredconfig)  
         except:
@@ -62,22 +171,34 @@ class Netapp(SnapHandler):
         debug("List of all volumes for this database: %s" % self._volname)
         super(Netapp, self).__init__(configname)
 
+    def __del__(self):
+        try:
+            debug("ZAPI session statistics: %s" % self._srv.stats())
+        except:
+            pass
+
     def _check_netapp_error(self, output, errmsg):
         if output.results_errno() != 0:
             raise Exception(self._exceptionbase, "%s. %s" % (errmsg, output.results_reason()))
     
-    def _volsize_to_num(self, volsize):
-        unit = volsize[-1].lower()
-        factor = 1
-        if unit == "m":
-            factor = 20
-        elif unit == "g":
-            factor = 30
-        elif unit == "t":
-            factor = 40
-        elif unit == "p":
-            factor = 50
-        return round(float(volsize[:-1])*(2**factor))
+    def _invoke_iter(self, buildelem, errmsg, maxrecords=500):
+        # Executes a *-get-iter call and yields all records from attributes-list, following next-tag page by page
+        # buildelem must return a new NaElement for each call
+        tag = None
+        while True:
+            elem = buildelem()
+            elem.child_add_string("max-records", str(maxrecords))
+            if tag is not None:
+                elem.child_add_string("tag", tag)
+            output = self._srv.invoke_elem(elem)
+            self._check_netapp_error(output, errmsg)
+            attrlist = output.child_get("attributes-list")
+            if (attrlist is not None and attrlist):
+                for ss in attrlist.children_get():
+                    yield ss
+            tag = output.child_get_string("next-tag")
+            if not tag:
+                break
 
     def _get_volume_info(self, volname):
         debug("Querying info for volume: %s" % volname)
@@ -123,14 +244,62 @@ class Netapp(SnapHandler):
                     info['origin'] = None
         return info
 
+    def _get_volume_state(self, volname):
+        # Returns volume state and junction path, or None if volume does not exist
+        def build():
+            elem = NaElement("volume-get-iter")
+            query = NaElement("query")
+            query_vol = NaElement("volume-attributes")
+            query_volume_id = NaElement("volume-id-attributes")
+            query_volume_id.child_add_string("name", volname)
+            query_vol.child_add(query_volume_id)
+            query.child_add(query_vol)
+            elem.child_add(query)
+            attr = NaElement("desired-attributes")
+            attr_vol = NaElement("volume-attributes")
+            id = NaElement("volume-id-attributes")
+            id.child_add(NaElement("junction-path"))
+            attr_vol.child_add(id)
+            state = NaElement("volume-state-attributes")
+            state.child_add(NaElement("state"))
+            attr_vol.child_add(state)
+            attr.child_add(attr_vol)
+            elem.child_add(attr)
+            return elem
+        for ss in self._invoke_iter(build, "Getting volume state failed", 1):
+            stateattr = ss.child_get('volume-state-attributes')
+            idattr = ss.child_get('volume-id-attributes')
+            return {'state': stateattr.child_get_string('state') if stateattr is not None else None,
+                'mountpoint': idattr.child_get_string('junction-path') if idattr is not None else None}
+        return None
+
+    def _wait_for(self, description, check):
+        # Polls until check returns True or the deadline passes
+        deadline = datetime.now() + timedelta(seconds=self._statetimeout)
+        while not check():
+            if datetime.now() > deadline:
+                raise Exception(self._exceptionbase, "Timed out waiting for %s" % description)
+            sleep(1)
+
+    def _parallel(self, function, items):
+        # Executes function for all items concurrently, raises the first error after all calls have finished
+        if len(items) <= 1:
+            return [function(item) for item in items]
+        pool = ThreadPool(len(items))
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.close()
+            pool.join()
+
     def _dropvolume(self, volname):
         debug("Dropping volume: %s" % volname)
         output = self._srv.invoke("volume-unmount", "volume-name", volname)
         self._check_netapp_error(output, "Unmounting volume %s failed" % volname)
-        sleep(10)
+        self._wait_for("volume %s to unmount" % volname, lambda: not (self._get_volume_state(volname) or {}).get('mountpoint'))
         output = self._srv.invoke("volume-offline", "name", volname)
         self._check_netapp_error(output, "Offlining volume %s failed" % volname)
-        sleep(10)
+        self._wait_for("volume %s to go offline" % volname, lambda: (self._get_volume_state(volname) or {}).get('state') == 'offline')
         output = self._srv.invoke("volume-destroy", "name", volname)
         self._check_netapp_error(output, "Dropping volume %s failed" % volname)
     
@@ -144,23 +313,27 @@ class Netapp(SnapHandler):
         return info
 
     def listclones(self):
-        # TODO: support multiple volumes - self._volname as array
-        elem = NaElement("volume-clone-get-iter")
-        elem.child_add_string("max-records", "50")
-        query = NaElement("query")
-        query.child_add_string("parent-volume", self._volname[0])
-        elem.child_add(query)
-        #
-        output = self._srv.invoke_elem(elem)
-        self._check_netapp_error(output, "List clones failed")
-        attrlist = output.child_get("attributes-list")
-        if (attrlist is not None and attrlist):
-            for ss in attrlist.children_get():
-                info = {}
-                info['origin'] = ss.child_get_string('parent-volume')
-                info['clonename'] = ss.child_get_string('volume')
-                info['mountpoint'] = ss.child_get_string('junction-path')
-                yield info
+        # Clones of all database volumes, fetched page by page with one query
+        def build():
+            elem = NaElement("volume-clone-get-iter")
+            query = NaElement("query")
+            query_clone = NaElement("volume-clone-info")
+            query_clone.child_add_string("parent-volume", "|".join(self._volname))
+            query.child_add(query_clone)
+            elem.child_add(query)
+            attr = NaElement("desired-attributes")
+            attr_clone = NaElement("volume-clone-info")
+            for a in ["parent-volume", "volume", "junction-path"]:
+                attr_clone.child_add(NaElement(a))
+            attr.child_add(attr_clone)
+            elem.child_add(attr)
+            return elem
+        for ss in self._invoke_iter(build, "List clones failed"):
+            info = {}
+            info['origin'] = ss.child_get_string('parent-volume')
+            info['clonename'] = ss.child_get_string('volume')
+            info['mountpoint'] = ss.child_get_string('junction-path')
+            yield info
 
     def mountstring(self, filesystemname):
         info = self.filesystem_info(filesystemname)
@@ -169,54 +342,106 @@ class Netapp(SnapHandler):
     def snap(self):
         snapname = "%s_%s" % (self.configname, datetime.now().strftime('%Y%m%dT%H%M%S'))
         debug("Snapshot name: %s" % snapname)
-        for vol in self._volname:
-            debug("Snapshotting volume: %s" % vol)
-            output = self._srv.invoke("snapshot-create", "volume", vol, "snapshot", snapname)
+        if not self._multivol:
+            debug("Snapshotting volume: %s" % self._volname[0])
+            output = self._srv.invoke("snapshot-create", "volume", self._volname[0], "snapshot", snapname)
             self._check_netapp_error(output, "Creating snapshot failed")
+        else:
+            # All volumes are snapshotted in one consistency group, so writes are fenced only once
+            debug("Snapshotting volumes in a consistency group: %s" % self._volname)
+            elem = NaElement("cg-start")
+            elem.child_add_string("snapshot", snapname)
+            elem.child_add_string("timeout", "relaxed")
+            volumes = NaElement("volumes")
+            for vol in self._volname:
+                volumes.child_add_string("volume-name", vol)
+            elem.child_add(volumes)
+            output = self._srv.invoke_elem(elem)
+            self._check_netapp_error(output, "Starting consistency group snapshot failed")
+            output = self._srv.invoke("cg-commit", "cg-id", output.child_get_string("cg-id"))
+            self._check_netapp_error(output, "Committing consistency group snapshot failed")
         return snapname
 
     def dropsnap(self, snapid):
-        for counter, vol in enumerate(self._volname):
+        def drop(vol):
             debug("Dropping snapshot on volume: %s" % vol)
             output = self._srv.invoke("snapshot-delete", "volume", vol, "snapshot", snapid)
-            if counter == 0:
+            if vol == self._volname[0]:
                 # Only check netapp error on the first volume, because user may add volumes later and on the new volumes older snapshot ID-s do not exist
                 self._check_netapp_error(output, "Failed to drop snapshot %s" % snapid)
+        self._parallel(drop, self._volname)
 
     def getsnapinfo(self, snapstruct):
         return snapstruct
 
+    def _volume_sizes(self):
+        # Sizes of all database volumes in bytes, queried in one call
+        def build():
+            elem = NaElement("volume-get-iter")
+            query = NaElement("query")
+            query_vol = NaElement("volume-attributes")
+            query_volume_id = NaElement("volume-id-attributes")
+            query_volume_id.child_add_string("name", "|".join(self._volname))
+            query_vol.child_add(query_volume_id)
+            query.child_add(query_vol)
+            elem.child_add(query)
+            attr = NaElement("desired-attributes")
+            attr_vol = NaElement("volume-attributes")
+            id = NaElement("volume-id-attributes")
+            id.child_add(NaElement("name"))
+            attr_vol.child_add(id)
+            space = NaElement("volume-space-attributes")
+            space.child_add(NaElement("size"))
+            attr_vol.child_add(space)
+            attr.child_add(attr_vol)
+            elem.child_add(attr)
+            return elem
+        sizes = {}
+        for ss in self._invoke_iter(build, "Failed to get volume size information"):
+            sizes[ss.child_get('volume-id-attributes').child_get_string('name')] = float(ss.child_get('volume-space-attributes').child_get_string('size'))
+        return sizes
+
     def listsnapshots(self, sortbycreation=False, sortreverse=False):
-        snapshots = []
-        for volname in self._volname:
-            debug("Getting volume info for volume: %s" % volname)
-            output = self._srv.invoke("volume-size", "volume", volname)
-            self._check_netapp_error(output, "Failed to get volume size information")
-            volsize = self._volsize_to_num(output.child_get_string("volume-size"))
+        volsizes = self._volume_sizes()
+        # Snapshots of all volumes are listed with one paged query, snapshots with the same name on different volumes are merged
+        def build():
+            elem = NaElement("snapshot-get-iter")
+            query = NaElement("query")
+            query_snap = NaElement("snapshot-info")
+            query_snap.child_add_string("volume", "|".join(self._volname))
+            query.child_add(query_snap)
+            elem.child_add(query)
+            attr = NaElement("desired-attributes")
+            attr_snap = NaElement("snapshot-info")
+            for a in ["name", "volume", "access-time", "busy", "total", "cumulative-total", "percentage-of-total-blocks", "cumulative-percentage-of-total-blocks"]:
+                attr_snap.child_add(NaElement(a))
+            attr.child_add(attr_snap)
+            elem.child_add(attr)
+            return elem
+        snapshots = {}
+        snaporder = []
+        for ss in self._invoke_iter(build, "Failed to list snapshots"):
+            volsize = volsizes[ss.child_get_string("volume")]
             pct_limit = round(2147483648*100/(volsize/self._blocksize))
-            output = self._srv.invoke("snapshot-list-info", "volume", volname)
-            self._check_netapp_error(output, "Failed to list snapshots")
-            snapshotlist = output.child_get("snapshots")
-            if (snapshotlist is not None and snapshotlist):
-                for ss in snapshotlist.children_get():
-                    snapinfo = {'id': ss.child_get_string("name"),
-                        'creation': datetime.utcfromtimestamp(float(ss.child_get_int("access-time"))),
-                        'numclones':  1 if ss.child_get_string("busy") == "true" else 0,
-                        'space_total': ss.child_get_int("cumulative-total")*self._blocksize if ss.child_get_int("cumulative-percentage-of-total-blocks") < pct_limit else round(volsize*ss.child_get_int("cumulative-percentage-of-total-blocks")/100),
-                        'space_unique': ss.child_get_int("total")*self._blocksize if ss.child_get_int("percentage-of-total-blocks") < pct_limit else round(volsize*ss.child_get_int("percentage-of-total-blocks")/100) 
-                    }
-                    try:
-                        existingitem = next(item for item in snapshots if item['id'] == snapinfo['id'])
-                        existingitem['space_total'] += snapinfo['space_total']
-                        existingitem['space_unique'] += snapinfo['space_unique']
-                        existingitem['numclones'] = max(existingitem['numclones'], snapinfo['numclones'])
-                    except StopIteration:
-                        snapshots.append(snapinfo)
+            snapinfo = {'id': ss.child_get_string("name"),
+                'creation': datetime.utcfromtimestamp(float(ss.child_get_int("access-time"))),
+                'numclones':  1 if ss.child_get_string("busy") == "true" else 0,
+                'space_total': ss.child_get_int("cumulative-total")*self._blocksize if ss.child_get_int("cumulative-percentage-of-total-blocks") < pct_limit else round(volsize*ss.child_get_int("cumulative-percentage-of-total-blocks")/100),
+                'space_unique': ss.child_get_int("total")*self._blocksize if ss.child_get_int("percentage-of-total-blocks") < pct_limit else round(volsize*ss.child_get_int("percentage-of-total-blocks")/100)
+            }
+            existingitem = snapshots.get(snapinfo['id'])
+            if existingitem is not None:
+                existingitem['space_total'] += snapinfo['space_total']
+                existingitem['space_unique'] += snapinfo['space_unique']
+                existingitem['numclones'] = max(existingitem['numclones'], snapinfo['numclones'])
+            else:
+                snapshots[snapinfo['id']] = snapinfo
+                snaporder.append(snapinfo['id'])
         if not sortbycreation:
-            return snapshots
+            return [snapshots[snapid] for snapid in snaporder]
         else:
-            return sorted(snapshots, key=operator.itemgetter('creation'), reverse=sortreverse)
-    
+            return sorted(snapshots.values(), key=operator.itemgetter('creation'), reverse=sortreverse)
+
     def clone(self, snapid, clonename):
         # Create root namespace
         if self._multivol:
@@ -237,7 +462,8 @@ class Netapp(SnapHandler):
             debug("Multivolume mode disabled")
             junction_prefix = "" 
         # Create the clones
-        for counter, vol in enumerate(self._volname):
+        def clonevolume(item):
+            counter, vol = item
             cname = clonename if not self._multivol else "%s%d" % (clonename, counter)
             debug("Cloning volume %s from snapshot %s as volume %s with junction path %s/%s" % (vol, snapid, cname, junction_prefix, cname))
             output = self._srv.invoke("volume-clone-create", "parent-volume", vol, "parent-snapshot", snapid, "volume", cname)
@@ -246,13 +472,13 @@ class Netapp(SnapHandler):
             self._check_netapp_error(output, "Mounting clone failed")
             output = self._srv.invoke("volume-set-option", "option-name", "nosnapdir", "option-value", "on", "volume", cname)
             self._check_netapp_error(output, "Setting attribute on clone failed")
+        self._parallel(clonevolume, list(enumerate(self._volname)))
 
     def dropclone(self, cloneid):
         info = self.filesystem_info(cloneid if not self._multivol else cloneid + "0")
         if info['origin'] != self._volname[0]:
             raise Exception(self._exceptionbase, "This clone does not belong to parent %s" % self._volname)
-        for counter, vol in enumerate(self._volname):
-            self._dropvolume(cloneid if not self._multivol else "%s%d" % (cloneid, counter))
+        self._parallel(self._dropvolume, [cloneid if not self._multivol else "%s%d" % (cloneid, counter) for counter in range(len(self._volname))])
         # Drop the root namespace
         if self._multivol:
             self._dropvolume(cloneid)
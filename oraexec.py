@@ -1,9 +1,77 @@
-import os, sys
-from subprocess import Popen, PIPE
+import os, sys, re, uuid
+from subprocess import Popen, PIPE, STDOUT
+from threading import Thread
 from backupcommon import BackupLogger, info, debug, error, exception
+from rmanmonitor import RmanMonitor, LongopsPoller
 from datetime import datetime, timedelta
 from tempfile import mkstemp, TemporaryFile
 
+def _writescript(stream, script, close=False):
+    # Writes the script to child process stdin, used from a separate thread so a long script and its output could not block each other
+    try:
+        stream.write(script)
+        stream.flush()
+        if close:
+            stream.close()
+    except IOError:
+        # sqlplus exited before reading the whole script, for example because of whenever sqlerror exit
+        pass
+
+class SqlplusSession(object):
+    # One sqlplus process that executes multiple scripts sent through stdin
+    # The end of each script output is detected from a sentinel line printed after the script
+    _exitline = re.compile(r'^\s*(exit|quit)\s*;?\s*$', re.IGNORECASE)
+    # Spool and settings changed by the previous script are reset to sqlplus defaults
+    _resetscript = "\n".join(["spool off", "whenever sqlerror continue none", "whenever oserror continue none",
+        "set echo off feedback 6 timing off serveroutput off pagesize 14 linesize 80 heading on termout on verify on",
+        "set trimout on trimspool off long 80 numwidth 10 newpage 1 colsep ' ' define on autocommit off",
+        "clear columns", "clear breaks", "clear computes", "ttitle off", "btitle off"])
+
+    def __init__(self, sqlplusbinary):
+        self._process = Popen([sqlplusbinary, '-S', '/nolog'], stdout=PIPE, stderr=STDOUT, stdin=PIPE)
+        self._sentinel = "ORAEXEC-SESSION-%s" % uuid.uuid4().hex
+        self._counter = 0
+        self.completed = False
+
+    def alive(self):
+        return self._process.poll() is None
+
+    def returncode(self):
+        return self._process.wait()
+
+    def lines(self, finalscript):
+        # Generator that yields script output lines until the sentinel
+        # completed is set to False when sqlplus exited before reaching the sentinel
+        self._counter += 1
+        self.completed = False
+        sentinel = "%s-%d" % (self._sentinel, self._counter)
+        # Exit would end the session, exitcommit behaviour is kept with an explicit commit
+        script = "\n".join([line for line in finalscript.splitlines() if not self._exitline.match(line)])
+        script = "%s\n%s\nspool off\nwhenever sqlerror continue none\nset termout on feedback off\ncommit;\nprompt %s\n" % (self._resetscript, script, sentinel)
+        writer = Thread(target=_writescript, args=(self._process.stdin, script))
+        writer.start()
+        try:
+            for line in iter(self._process.stdout.readline, ''):
+                if line.rstrip() == sentinel:
+                    self.completed = True
+                    break
+                yield line
+        finally:
+            if not self.completed:
+                # Caller stopped reading early, skip the rest of the output so the next script would start clean
+                for line in iter(self._process.stdout.readline, ''):
+                    if line.rstrip() == sentinel:
+                        self.completed = True
+                        break
+            writer.join()
+
+    def close(self):
+        if self.alive():
+            try:
+                self._process.communicate(input="exit\n")
+            except:
+                pass
+
 class OracleExec(object):
     oraclehome = None
     tnspath = None
@@ -14,6 +82,12 @@ class OracleExec(object):
         self.tnspath = tnspath
         if sid is not None:
             self.oraclesid = sid
+        self._sessionmode = False
+        self._session = None
+        self._rmanmonitor = None
+        self._longops = None
+        # Exit code, duration and written/read bytes (when monitored) of the latest RMAN execution
+        self.lastrman = {}
         debug("Oracle home: %s" % self.oraclehome)
 
     def _setenv(self):
@@ -25,10 +99,27 @@ class OracleExec(object):
         os.environ['NLS_DATE_FORMAT'] = 'yyyy-mm-dd hh24:mi:ss'
         os.environ['TNS_ADMIN'] = self.tnspath
 
+    def monitorrman(self, statusfile, interval=60):
+        # Report RMAN progress from the log file while RMAN is running
+        self._rmanmonitor = (statusfile, interval)
+
+    def monitorlongops(self, connectstring, metricsfile, interval=60, label='RMAN longops'):
+        # Poll v$session_longops from a separate sqlplus connection while RMAN is running
+        self._longops = (connectstring, metricsfile, interval, label)
+
     def rman(self, finalscript):
         self._setenv()
+        self.lastrman = {}
         debug("RMAN execution starts")
         BackupLogger.close()
+        monitor = None
+        if self._rmanmonitor is not None:
+            monitor = RmanMonitor(BackupLogger.logfile, self._rmanmonitor[0], self._rmanmonitor[1], finalscript)
+            monitor.start()
+        poller = None
+        if self._longops is not None:
+            poller = LongopsPoller(os.path.join(self.oraclehome, 'bin', 'sqlplus'), *self._longops)
+            poller.start()
         starttime = datetime.now()
         with TemporaryFile() as f:
             p = Popen([os.path.join(self.oraclehome, 'bin', 'rman'), "log", BackupLogger.logfile, "append"], stdout=f, stderr=f, stdin=PIPE)
@@ -36,6 +127,12 @@ class OracleExec(object):
             p.communicate(input=finalscript)
         endtime = datetime.now()
         BackupLogger.init()
+        self.lastrman = {'returncode': p.returncode, 'seconds': round((endtime-starttime).total_seconds(), 3)}
+        if monitor is not None:
+            monitor.stop(p.returncode)
+            self.lastrman['bytes'] = monitor.totalbytes()
+        if poller is not None:
+            poller.stop()
         debug("RMAN execution time %s" % (endtime-starttime))
         # If RMAN exists with any code except 0, then there was some error
         if p.returncode != 0:
@@ -44,8 +141,85 @@ class OracleExec(object):
         else:
             debug("RMAN execution successful")
 
+    def startsession(self):
+        # Following sqlplus() calls reuse one sqlplus process instead of starting a new one for each call
+        self._sessionmode = True
+
+    def closesession(self):
+        self._sessionmode = False
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+            debug("SQL*Plus session closed")
+
+    def _startsession(self):
+        # Returns True if the sqlplus session is running
+        if self._session is None or not self._session.alive():
+            try:
+                self._session = SqlplusSession(os.path.join(self.oraclehome, 'bin', 'sqlplus'))
+                debug("SQL*Plus session started")
+            except OSError as detail:
+                debug("Starting SQL*Plus session failed, falling back to a new process for each call: %s" % detail)
+                self._sessionmode = False
+                self._session = None
+        return self._session is not None
+
+    def _sqlplus_session_lines(self, finalscript):
+        debug("SQL*Plus execution starts in session")
+        BackupLogger.close()
+        try:
+            for line in self._session.lines(finalscript):
+                yield line
+        finally:
+            BackupLogger.init()
+        if not self._session.completed:
+            # sqlplus exited in the middle of the script, the next call starts a new session
+            returncode = self._session.returncode()
+            self._session = None
+            if returncode != 0:
+                error("SQL*Plus exited with code %d" % returncode)
+                raise Exception('sqlplus', "sqlplus exited with code %d" % returncode)
+        debug("SQL*Plus execution successful")
+
+    def _sqlplus_process_lines(self, finalscript):
+        debug("SQL*Plus execution starts")
+        BackupLogger.close()
+        p = Popen([os.path.join(self.oraclehome, 'bin', 'sqlplus'), '-S', '/nolog'], stdout=PIPE, stderr=STDOUT, stdin=PIPE)
+        writer = Thread(target=_writescript, args=(p.stdin, finalscript, True))
+        writer.start()
+        try:
+            for line in iter(p.stdout.readline, ''):
+                yield line
+        finally:
+            # Read the rest of the output also when the caller stopped reading early
+            p.stdout.read()
+            writer.join()
+            p.wait()
+            BackupLogger.init()
+        if p.returncode != 0:
+            error("SQL*Plus exited with code %d" % p.returncode)
+            raise Exception('sqlplus', "sqlplus exited with code %d" % p.returncode)
+        else:
+            debug("SQL*Plus execution successful")
+
+    def sqlplus_lines(self, finalscript):
+        # Generator that yields sqlplus output lines as soon as sqlplus produces them
+        # Exception is raised after the last line if sqlplus exits with an error
+        self._setenv()
+        if self._sessionmode and self._startsession():
+            lines = self._sqlplus_session_lines(finalscript)
+        else:
+            lines = self._sqlplus_process_lines(finalscript)
+        for line in lines:
+            yield line
+
     def sqlplus(self, finalscript, silent=False):
         self._setenv()
+        if self._sessionmode and self._startsession():
+            output = "".join(self._sqlplus_session_lines(finalscript))
+            if silent:
+                return output
+            return
         with TemporaryFile() as f:
             args = [os.path.join(self.oraclehome, 'bin', 'sqlplus')]
             if silent:
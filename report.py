@@ -1,15 +1,24 @@
 #!/usr/bin/python2
 
-import os, sys, json
+import os, sys, json, csv
 from backupcommon import scriptpath, Configuration, BackupLogger, BackupTemplate, info, error, debug, exception, create_snapshot_class
 from tempfile import mkstemp
+from multiprocessing import Pool
 from oraexec import OracleExec
 
+outputformats = ['text', 'json', 'csv']
+
 def printhelp():
-    print "Usage: report.py [comma separated list of databases]"
+    print "Usage: report.py [--%s] [comma separated list of databases]" % '|--'.join(outputformats)
     sys.exit(2)
 
-if len(sys.argv) not in [1,2]:
+arguments = sys.argv[1:]
+outputformat = 'text'
+if len(arguments) > 0 and arguments[0].startswith('--'):
+    outputformat = arguments.pop(0)[2:]
+    if outputformat not in outputformats:
+        printhelp()
+if len(arguments) not in [0,1]:
     printhelp()
 
 # Directory where the executable script is located
@@ -18,7 +27,7 @@ scriptpath = scriptpath()
 # Read configuration
 logf = mkstemp(prefix='backupreport-', suffix='.log')
 os.close(logf[0])
-Configuration.init('generic')
+Configuration.init('generic', additionaldefaults={'reportworkers': '4'})
 BackupLogger.init(logf[1], 'reporting')
 Configuration.substitutions.update( {'logfile': BackupLogger.logfile, 'autorestorecatalog': Configuration.get('autorestorecatalog', 'autorestore')} )
 reporttemplate = BackupTemplate('reporttemplate.cfg')
@@ -31,55 +40,104 @@ def exec_sqlplus(oraexec, script, header = 'sqlplusheader'):
             yield(line.strip()[8:])
 
 def process_database(dbname):
+    # Collects report information for one database, executed in a separate worker process
     Configuration.defaultsection = dbname
     Configuration.substitutions.update({'dbname': dbname})
-    oraexec = OracleExec(oraclehome=Configuration.get('oraclehome', 'generic'), tnspath=os.path.join(scriptpath, Configuration.get('tnsadmin', 'generic')))
-    # Read job status information from the database
-    jobinfo = {}
-    for line in exec_sqlplus(oraexec, reporttemplate.get('jobstatus')):
-        j = json.loads(line)
-        if j["type"] == "job":
-            if j["job_name"] == "ARCHLOGBACKUP_JOB":
-                jobinfo["archlog"] = j
-            elif j["job_name"] == "IMAGECOPY_JOB":
-                jobinfo["imagecopy"] = j
-        elif j["type"] == "exec":
-            if j["job_name"] == "ARCHLOGBACKUP_JOB":
-                jobinfo["archlogexec"] = j
-            elif j["job_name"] == "IMAGECOPY_JOB":
-                jobinfo["imagecopyexec"] = j
-    # Read snapshot information
-    zfs = create_snapshot_class(dbname)
-    snaps = zfs.listsnapshots(True, True)
-    # Autorestore information
-    autorestoreinfo = None
-    try:
-        for line in exec_sqlplus(oraexec, reporttemplate.get('autorestorestatus'), 'sqlplusautorestoreheader'):
-            autorestoreinfo = json.loads(line)
-    except:
-        pass
-    # Print output
-    print "%s:" % dbname
+    result = {'dbname': dbname, 'jobinfo': {}, 'snapshots': 0, 'latestsnapshot': None, 'oldestsnapshot': None, 'autorestore': None, 'error': None}
     try:
-        print "  Backup job: %s, last: %s, duration: %s, last failure: %s" % (jobinfo['imagecopy']['state'], jobinfo['imagecopy']['last_start_date'], jobinfo['imagecopy']['last_run_duration'], jobinfo['imagecopyexec']['last_failed'])
-        print "  Archivelog job: %s, last: %s, duration: %s, last failure: %s" % (jobinfo['archlog']['state'], jobinfo['archlog']['last_start_date'], jobinfo['archlog']['last_run_duration'], jobinfo['archlogexec']['last_failed'])
+        oraexec = OracleExec(oraclehome=Configuration.get('oraclehome', 'generic'), tnspath=os.path.join(scriptpath, Configuration.get('tnsadmin', 'generic')))
+        # Read job status information from the database
+        jobinfo = result['jobinfo']
+        for line in exec_sqlplus(oraexec, reporttemplate.get('jobstatus')):
+            j = json.loads(line)
+            if j["type"] == "job":
+                if j["job_name"] == "ARCHLOGBACKUP_JOB":
+                    jobinfo["archlog"] = j
+                elif j["job_name"] == "IMAGECOPY_JOB":
+                    jobinfo["imagecopy"] = j
+            elif j["type"] == "exec":
+                if j["job_name"] == "ARCHLOGBACKUP_JOB":
+                    jobinfo["archlogexec"] = j
+                elif j["job_name"] == "IMAGECOPY_JOB":
+                    jobinfo["imagecopyexec"] = j
+        # Read snapshot information
+        zfs = create_snapshot_class(dbname)
+        snaps = zfs.listsnapshots(True, True)
+        result['snapshots'] = len(snaps)
         if len(snaps) > 0:
-            firstsnap = zfs.getsnapinfo(snaps[0])
-            lastsnap = zfs.getsnapinfo(snaps[-1])
-            print "  Snapshots: %d, latest: %s, oldest: %s" % (len(snaps), firstsnap["creation"], lastsnap["creation"])
-        else:
-            print "  Snapshots: none"
-        if autorestoreinfo is not None:
-            print "  Last successful restore: %s, last restore failure: %s, last successful validation: %s, avg difference from target (s): %d, avg restore time (min): %d" % (autorestoreinfo["last_success"], autorestoreinfo["last_fail"], autorestoreinfo["last_validated"], autorestoreinfo["avgdiff"], autorestoreinfo["avgrestoremin"])
-    except:
-        print "  Error getting information."
+            result['latestsnapshot'] = str(zfs.getsnapinfo(snaps[0])["creation"])
+            result['oldestsnapshot'] = str(zfs.getsnapinfo(snaps[-1])["creation"])
+        # Autorestore information
+        try:
+            for line in exec_sqlplus(oraexec, reporttemplate.get('autorestorestatus'), 'sqlplusautorestoreheader'):
+                result['autorestore'] = json.loads(line)
+        except:
+            pass
+    except Exception as detail:
+        # Logged only to the log file, so stdout would stay machine readable
+        debug("Error getting information for %s: %s" % (dbname, detail))
+        result['error'] = str(detail)
+    return result
+
+def print_text(results):
+    for r in results:
+        jobinfo = r['jobinfo']
+        autorestoreinfo = r['autorestore']
+        print "%s:" % r['dbname']
+        try:
+            if r['error'] is not None:
+                raise Exception('report', r['error'])
+            print "  Backup job: %s, last: %s, duration: %s, last failure: %s" % (jobinfo['imagecopy']['state'], jobinfo['imagecopy']['last_start_date'], jobinfo['imagecopy']['last_run_duration'], jobinfo['imagecopyexec']['last_failed'])
+            print "  Archivelog job: %s, last: %s, duration: %s, last failure: %s" % (jobinfo['archlog']['state'], jobinfo['archlog']['last_start_date'], jobinfo['archlog']['last_run_duration'], jobinfo['archlogexec']['last_failed'])
+            if r['snapshots'] > 0:
+                print "  Snapshots: %d, latest: %s, oldest: %s" % (r['snapshots'], r['latestsnapshot'], r['oldestsnapshot'])
+            else:
+                print "  Snapshots: none"
+            if autorestoreinfo is not None:
+                print "  Last successful restore: %s, last restore failure: %s, last successful validation: %s, avg difference from target (s): %d, avg restore time (min): %d" % (autorestoreinfo["last_success"], autorestoreinfo["last_fail"], autorestoreinfo["last_validated"], autorestoreinfo["avgdiff"], autorestoreinfo["avgrestoremin"])
+        except:
+            print "  Error getting information."
+
+def print_json(results):
+    print json.dumps(results, indent=2, sort_keys=True)
 
-excludelist = ['generic','rman','zfssa','autorestore']
+def print_csv(results):
+    columns = [('backupjob_state', 'imagecopy', 'state'), ('backupjob_last_start', 'imagecopy', 'last_start_date'),
+        ('backupjob_last_duration', 'imagecopy', 'last_run_duration'), ('backupjob_last_failure', 'imagecopyexec', 'last_failed'),
+        ('archlogjob_state', 'archlog', 'state'), ('archlogjob_last_start', 'archlog', 'last_start_date'),
+        ('archlogjob_last_duration', 'archlog', 'last_run_duration'), ('archlogjob_last_failure', 'archlogexec', 'last_failed')]
+    autorestorecolumns = ['last_success', 'last_fail', 'last_validated', 'avgdiff', 'avgrestoremin']
+    writer = csv.writer(sys.stdout)
+    writer.writerow(['dbname'] + [c[0] for c in columns] + ['snapshots', 'latestsnapshot', 'oldestsnapshot'] + ["autorestore_%s" % c for c in autorestorecolumns] + ['error'])
+    for r in results:
+        row = [r['dbname']]
+        row.extend([r['jobinfo'].get(c[1], {}).get(c[2], '') for c in columns])
+        row.extend([r['snapshots'], r['latestsnapshot'] or '', r['oldestsnapshot'] or ''])
+        row.extend([(r['autorestore'] or {}).get(c, '') for c in autorestorecolumns])
+        row.append(r['error'] or '')
+        writer.writerow(row)
+
+excludelist = ['generic','rman','zfssa','autorestore','netapp','softnas','huaweidorado']
 includelist = []
-if len(sys.argv) == 2:
-    includelist = sys.argv[1].split(",")
+if len(arguments) == 1:
+    includelist = arguments[0].split(",")
+
+# Collect information from all sections using a bounded pool of worker processes
+databases = [dbname for dbname in Configuration.sections() if dbname not in excludelist and (len(includelist) == 0 or dbname in includelist)]
+workers = max(1, min(int(Configuration.get('reportworkers', 'generic')), len(databases)))
+if workers > 1:
+    pool = Pool(workers)
+    try:
+        results = pool.map(process_database, databases)
+    finally:
+        pool.close()
+        pool.join()
+else:
+    results = [process_database(dbname) for dbname in databases]
 
-# Loop through all sections
-for dbname in Configuration.sections():
-    if dbname not in excludelist and (len(includelist) == 0 or dbname in includelist):
-        process_database(dbname)
+if outputformat == 'json':
+    print_json(results)
+elif outputformat == 'csv':
+    print_csv(results)
+else:
+    print_text(results)
@@ -22,12 +22,17 @@ class RestoreDB(object):
     _successful_clone = False
     _successful_mount = False
     _mountpaths = []
+    _autoclonename = None
+    _preparedclone = False
+    _sidsuffix = ''
     targettime = None
 
     def __init__(self, configname):
         self._restoretemplate = BackupTemplate('restoretemplate.cfg')
         self._configname = configname
         self._snap = create_snapshot_class(configname)
+        self._dbparams = {}
+        self._mountpaths = []
 
     def set_mount_path(self, mountdest):
         if mountdest is None or not os.path.exists(mountdest) or not os.path.isdir(mountdest):
@@ -40,6 +45,18 @@ class RestoreDB(object):
             raise Exception('restore', "Restore directory %s not found or is not a proper directory" % restoredest)
         self._restoredest = restoredest
 
+    def set_autoclone_name(self, clonename):
+        self._autoclonename = clonename
+
+    def set_prepared_clone(self, snapid):
+        # Clone has already been created in advance by autoclone
+        self.sourcesnapid = snapid
+        self._preparedclone = True
+
+    def set_sid_suffix(self, suffix):
+        # Concurrent restores on the same host need a different SID and db_unique_name, even if db_name is the same
+        self._sidsuffix = suffix
+
     def set_restore_target_time(self, targettime):
         if targettime.tzinfo is None:
             raise Exception('restore', 'set_restore_target_time expects a datetime object with time zone information')
@@ -53,12 +70,27 @@ class RestoreDB(object):
         finalscript = "%s\n%s\n%s" % (self._restoretemplate.get('rmanheader'), commands, self._restoretemplate.get('rmanfooter'))
         self._exec.rman(finalscript)
 
-    def _exec_sqlplus(self, commands, headers=True, returnoutput=False):
+    def _sqlplus_script(self, commands, headers=True):
         if headers:
-            finalscript = "%s\n%s\n%s" % (self._restoretemplate.get('sqlplusheader'), commands, self._restoretemplate.get('sqlplusfooter'))
+            return "%s\n%s\n%s" % (self._restoretemplate.get('sqlplusheader'), commands, self._restoretemplate.get('sqlplusfooter'))
         else:
-            finalscript = commands
-        return self._exec.sqlplus(finalscript, silent=returnoutput)
+            return commands
+
+    def _exec_sqlplus(self, commands, headers=True, returnoutput=False):
+        return self._exec.sqlplus(self._sqlplus_script(commands, headers), silent=returnoutput)
+
+    def _exec_sqlplus_lines(self, commands, headers=True):
+        # Generator of sqlplus output lines
+        return self._exec.sqlplus_lines(self._sqlplus_script(commands, headers))
+
+    def _createexec(self, sid):
+        self._exec = OracleExec(oraclehome=Configuration.get('oraclehome', 'generic'),
+            tnspath=os.path.join(scriptpath(), Configuration.get('tnsadmin', 'generic')),
+            sid=sid)
+        if Configuration.get('sqlplussession', 'generic').upper() == 'TRUE':
+            self._exec.startsession()
+        if Configuration.get('longopsmonitor', 'generic').upper() == 'TRUE':
+            self._exec.monitorlongops('/ as sysdba', os.path.join(os.path.dirname(BackupLogger.logfile), "%s_longops.json" % self._configname), int(Configuration.get('longopsinterval', 'generic')), "%s restore" % self._configname)
 
     # Restore actions
     def _createinitora(self):
@@ -71,8 +103,10 @@ class RestoreDB(object):
             f.write(contents)
 
     def clone(self, autorestore=True):
-        if autorestore:
-            self.sourcesnapid = self._snap.autoclone()
+        if autorestore and self._preparedclone:
+            debug("Using clone prepared from snapshot %s" % self.sourcesnapid)
+        elif autorestore:
+            self.sourcesnapid = self._snap.autoclone(self._autoclonename)
         else:
             self.clonename = "restore_%s_%s" % (self._configname, datetime.now().strftime("%Y%m%d_%H%M%S"))
             self._snap.clone(self.sourcesnapid, self.clonename)
@@ -120,6 +154,7 @@ class RestoreDB(object):
             catalogstatements.append("catalog start with '%s/data_' noprompt;" % item) 
         Configuration.substitutions.update({
             'db_name': self._dbparams['dbname'],
+            'db_unique_name': "%s%s" % (self._dbparams['dbname'], self._sidsuffix),
             'db_compatible': dbconfig.get('dbparams','compatible'),
             'db_files': dbconfig.get('dbparams','db_files'),
             'db_undotbs': dbconfig.get('dbparams','undo_tablespace'),
@@ -157,13 +192,12 @@ class RestoreDB(object):
             debug('ACTION: disable block change tracking')
             self._exec_sqlplus(self._restoretemplate.get('disablebct'))
         debug('ACTION: create missing datafiles')
-        output = self._exec_sqlplus(self._restoretemplate.get('switchdatafiles'), returnoutput=True)
-        switchdfscript = ""
-        for line in output.splitlines():
+        switchdfscript = []
+        for line in self._exec_sqlplus_lines(self._restoretemplate.get('switchdatafiles')):
             if line.startswith('RENAMEDF-'):
-                switchdfscript+= "%s\n" % line.strip()[9:]
+                switchdfscript.append("%s\n" % line.strip()[9:])
         debug('ACTION: switch and recover')
-        self._exec_rman("%s\n%s" % (switchdfscript, self._restoretemplate.get('recoverdatafiles')))
+        self._exec_rman("%s\n%s" % ("".join(switchdfscript), self._restoretemplate.get('recoverdatafiles')))
 
     # Orchestrator
     def pit_restore(self, mountpath, sid):
@@ -173,9 +207,7 @@ class RestoreDB(object):
         self._restoresid = sid
         self._set_parameters()
         self._createinitora()
-        self._exec = OracleExec(oraclehome=Configuration.get('oraclehome', 'generic'),
-            tnspath=os.path.join(scriptpath(), Configuration.get('tnsadmin', 'generic')),
-            sid=sid)
+        self._createexec(sid)
         self._run_restore()
 
     def run(self):
@@ -191,9 +223,7 @@ class RestoreDB(object):
             raise Exception('restore', 'Mount failed')
         self._set_parameters()
         self._createinitora()
-        self._exec = OracleExec(oraclehome=Configuration.get('oraclehome', 'generic'),
-            tnspath=os.path.join(scriptpath(), Configuration.get('tnsadmin', 'generic')),
-            sid=self._dbparams['dbname'])
+        self._createexec(Configuration.substitutions['db_unique_name'])
         #
         self._run_restore()
 
@@ -234,6 +264,8 @@ class RestoreDB(object):
             self._exec_sqlplus(self._restoretemplate.get('shutdownabort'))
         except:
             pass
+        if self._exec is not None:
+            self._exec.closesession()
         if self._successful_mount:
             try:
                 self._unmount()
@@ -241,7 +273,7 @@ class RestoreDB(object):
                 exception("Error unmounting")
         if self._successful_clone:
             try:
-                self._snap.dropautoclone()
+                self._snap.dropautoclone(self._autoclonename)
             except:
                 exception("Error dropping clone")
         self.endtime = datetime.now()
@@ -0,0 +1,280 @@
+import os, re, json, hashlib
+from datetime import datetime, timedelta
+from threading import Thread, Event
+from subprocess import Popen, PIPE, STDOUT
+from backupcommon import info, debug, size2str
+
+class RmanChannel(object):
+    # Progress of one RMAN channel
+
+    def __init__(self, name, started):
+        self.name = name
+        self.sid = None
+        self.started = started
+        self.activity = None
+        self.files = 0
+        self.bytes = 0
+
+    def add_file(self, path):
+        self.files += 1
+        try:
+            self.bytes += os.path.getsize(path)
+        except OSError:
+            # For example ASM paths can't be checked from the OS
+            pass
+
+    def throughput(self, now):
+        # MB/s since RMAN was started, log lines are read in batches so allocation time is not exact
+        seconds = (now - self.started).total_seconds()
+        return self.bytes / 1048576.0 / seconds if seconds > 0 else 0.0
+
+    def status(self, now):
+        return {'channel': self.name, 'sid': self.sid, 'activity': self.activity, 'files': self.files,
+                'bytes': self.bytes, 'mbps': round(self.throughput(now), 2)}
+
+class RmanMonitor(object):
+    # Follows the RMAN log file while RMAN is running and reports progress of each channel
+    # to the console and to a JSON status file
+    _allocated = re.compile(r'^allocated channel: (\S+)')
+    _channelline = re.compile(r'^channel (\S+): (.*)$')
+    _sid = re.compile(r'SID=(\d+)')
+    _piecehandle = re.compile(r'piece handle=(\S+)')
+    _readpiece = re.compile(r'reading from backup piece (\S+)')
+    _outputfile = re.compile(r'^output file name=(\S+)')
+    _historysize = 20
+
+    def __init__(self, logfile, statusfile, interval, script):
+        self._logfile = logfile
+        self._statusfile = statusfile
+        self._interval = timedelta(seconds=interval)
+        # Completed byte counts of the earlier runs of the same script are used for estimating ETA
+        self._scriptkey = hashlib.md5(script).hexdigest()[:8]
+        self._history = {}
+        try:
+            with open(self._statusfile, 'r') as f:
+                self._history = json.load(f).get('history', {})
+        except (IOError, ValueError):
+            pass
+        self._channels = {}
+        self._order = []
+        self._lastchannel = None
+        self._pendingfiles = []
+        # Level 1 pieces are written by the backup and read again by recover copy, each file is counted only once
+        self._counted = set()
+        self._partial = ''
+        self._stopped = Event()
+        self._thread = None
+
+    def _channel(self, name):
+        if name not in self._channels:
+            self._channels[name] = RmanChannel(name, self._started)
+            self._order.append(name)
+        self._lastchannel = self._channels[name]
+        return self._lastchannel
+
+    def _addfile(self, channel, path):
+        if path not in self._counted:
+            self._counted.add(path)
+            channel.add_file(path)
+
+    def parse(self, line):
+        m = self._allocated.match(line)
+        if m:
+            self._channel(m.group(1))
+            return
+        m = self._channelline.match(line)
+        if m:
+            channel = self._channel(m.group(1))
+            message = m.group(2)
+            s = self._sid.search(message)
+            if s and channel.sid is None:
+                channel.sid = int(s.group(1))
+            if message.startswith('starting'):
+                channel.activity = message
+            elif message.startswith('finished'):
+                channel.activity = None
+            elif 'complete' in message:
+                # Output files of datafile and archived log copies are printed before the channel completion line
+                for path in self._pendingfiles:
+                    self._addfile(channel, path)
+                self._pendingfiles = []
+                channel.activity = None
+            for r in [self._piecehandle, self._readpiece]:
+                p = r.search(message)
+                if p:
+                    self._addfile(channel, p.group(1))
+            return
+        m = self._piecehandle.match(line)
+        if m and self._lastchannel is not None:
+            # Piece handle follows the finished piece line of the same channel
+            self._addfile(self._lastchannel, m.group(1))
+            return
+        m = self._outputfile.match(line)
+        if m:
+            self._pendingfiles.append(m.group(1))
+
+    def _readlog(self):
+        # Reads the lines RMAN has appended to the log file since the last read
+        try:
+            with open(self._logfile, 'r') as f:
+                f.seek(self._offset)
+                data = f.read()
+                self._offset = f.tell()
+        except IOError:
+            return
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self.parse(line.strip())
+
+    def totalbytes(self):
+        return sum([c.bytes for c in self._channels.values()])
+
+    def status(self, state):
+        now = datetime.now()
+        totalbytes = self.totalbytes()
+        seconds = (now - self._started).total_seconds()
+        mbps = totalbytes / 1048576.0 / seconds if seconds > 0 else 0.0
+        expected = self._history.get(self._scriptkey, {}).get('bytes')
+        eta = None
+        if state == 'running' and expected and mbps > 0 and expected > totalbytes:
+            eta = str(timedelta(seconds=int((expected - totalbytes) / 1048576.0 / mbps)))
+        return {'state': state, 'pid': os.getpid(), 'started': self._started.strftime('%Y-%m-%d %H:%M:%S'),
+                'updated': now.strftime('%Y-%m-%d %H:%M:%S'), 'elapsed': str(now - self._started).split('.')[0],
+                'bytes': totalbytes, 'expectedbytes': expected, 'mbps': round(mbps, 2), 'eta': eta,
+                'channels': [self._channels[name].status(now) for name in self._order],
+                'history': self._history}
+
+    def report(self, state):
+        s = self.status(state)
+        info("RMAN %s: %s done in %s, %.1f MB/s%s" % (state, size2str(s['bytes']), s['elapsed'], s['mbps'], ", ETA %s" % s['eta'] if s['eta'] else ''))
+        for c in s['channels']:
+            info("  %s: %s, %d files, %.1f MB/s%s" % (c['channel'], size2str(c['bytes']), c['files'], c['mbps'], " (%s)" % c['activity'] if c['activity'] else ''))
+        # Write to a temporary file first, so readers would never see a partial status file
+        tmpfile = "%s.tmp" % self._statusfile
+        with open(tmpfile, 'w') as f:
+            json.dump(s, f, indent=2, sort_keys=True)
+        os.rename(tmpfile, self._statusfile)
+
+    def _run(self):
+        lastreport = datetime.now()
+        while not self._stopped.wait(5):
+            self._readlog()
+            if datetime.now() - lastreport >= self._interval:
+                lastreport = datetime.now()
+                try:
+                    self.report('running')
+                except (IOError, OSError) as detail:
+                    debug("Writing RMAN status failed: %s" % detail)
+
+    def start(self):
+        # Must be called before RMAN starts writing to the log file
+        self._started = datetime.now()
+        self._offset = os.path.getsize(self._logfile) if os.path.isfile(self._logfile) else 0
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, returncode):
+        self._stopped.set()
+        self._thread.join()
+        self._readlog()
+        if self._partial:
+            self.parse(self._partial.strip())
+        if self._lastchannel is not None:
+            for path in self._pendingfiles:
+                self._addfile(self._lastchannel, path)
+        state = 'finished' if returncode == 0 else 'failed'
+        if returncode == 0:
+            self._history[self._scriptkey] = {'bytes': self.totalbytes(), 'finished': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+            # Keep only the most recently finished scripts
+            for key in sorted(self._history.keys(), key=lambda k: self._history[k].get('finished'))[:-self._historysize]:
+                del self._history[key]
+        try:
+            self.report(state)
+        except (IOError, OSError) as detail:
+            debug("Writing RMAN status failed: %s" % detail)
+
+class LongopsPoller(object):
+    # Polls v$session_longops for RMAN aggregate rows while RMAN is running
+    # Samples are appended as JSON lines to the metrics file and summarized in the session log when RMAN finishes
+    _query = """whenever sqlerror exit failure
+set pages 0 lines 400 feedback off heading off
+conn %s
+select 'LONGOPS: '||sid||'|'||serial#||'|'||opname||'|'||sofar||'|'||totalwork||'|'||units||'|'||nvl(time_remaining,-1)||'|'||elapsed_seconds
+  from v$session_longops
+  where opname like 'RMAN%%aggregate%%' and start_time >= to_date('%s', 'yyyy-mm-dd hh24:mi:ss') - 1/1440
+  order by start_time;
+exit
+"""
+
+    def __init__(self, sqlplusbinary, connectstring, metricsfile, interval, label):
+        self._sqlplusbinary = sqlplusbinary
+        self._connectstring = connectstring
+        self._metricsfile = metricsfile
+        self._interval = interval
+        self._label = label
+        self._latest = {}
+        self._order = []
+        self._samples = 0
+        # Session log file is closed while RMAN runs, samples are written to it in stop()
+        self._messages = []
+        self._stopped = Event()
+        self._thread = None
+
+    def poll(self):
+        # Returns list of longops rows from the database
+        p = Popen([self._sqlplusbinary, '-S', '-L', '/nolog'], stdout=PIPE, stderr=STDOUT, stdin=PIPE)
+        output, outerr = p.communicate(input=self._query % (self._connectstring, self._started.strftime('%Y-%m-%d %H:%M:%S')))
+        if p.returncode != 0:
+            raise Exception('longops', "sqlplus exited with code %d" % p.returncode)
+        rows = []
+        for line in output.splitlines():
+            if line.startswith('LONGOPS: '):
+                sid, serial, opname, sofar, totalwork, units, remaining, elapsed = line[9:].strip().split('|')
+                sofar, totalwork = int(sofar), int(totalwork)
+                rows.append({'sid': int(sid), 'serial': int(serial), 'opname': opname, 'sofar': sofar, 'totalwork': totalwork,
+                    'units': units, 'pct': round(100.0*sofar/totalwork, 1) if totalwork > 0 else None,
+                    'time_remaining': int(remaining) if int(remaining) >= 0 else None, 'elapsed_seconds': int(elapsed)})
+        return rows
+
+    def _record(self, rows):
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with open(self._metricsfile, 'a') as f:
+            for row in rows:
+                row.update({'time': now, 'rmanstart': self._started.strftime('%Y-%m-%d %H:%M:%S'), 'label': self._label})
+                f.write("%s\n" % json.dumps(row, sort_keys=True))
+                key = (row['sid'], row['serial'], row['opname'])
+                if key not in self._latest:
+                    self._order.append(key)
+                self._latest[key] = row
+                self._samples += 1
+                message = "%s: %s %d/%d %s (%s%%), time remaining %s s" % (self._label, row['opname'], row['sofar'], row['totalwork'], row['units'], row['pct'], row['time_remaining'])
+                self._messages.append("%s %s" % (now, message))
+                info(message)
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self._record(self.poll())
+            except Exception as detail:
+                # Polling is only informational, RMAN must not be disturbed by it
+                info("%s: polling v$session_longops failed: %s" % (self._label, detail))
+
+    def start(self):
+        self._started = datetime.now()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        # Must be called after the session log file is reopened
+        self._stopped.set()
+        self._thread.join(self._interval)
+        messages, self._messages = self._messages, []
+        for message in messages:
+            debug("longops sample at %s" % message)
+        debug("%s: %d v$session_longops samples written to %s" % (self._label, self._samples, self._metricsfile))
+        for key in self._order:
+            row = self._latest[key]
+            debug("%s: last sample %s sid=%d sofar=%d totalwork=%d %s elapsed=%d s remaining=%s s" % (self._label, row['opname'], row['sid'], row['sofar'], row['totalwork'], row['units'], row['elapsed_seconds'], row['time_remaining']))
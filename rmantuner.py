@@ -0,0 +1,92 @@
+import re
+from metrics import MetricsStore, median
+
+class RmanPlan(object):
+    # Channel count and section size for one RMAN backup, with the predicted load of the busiest channel
+
+    def __init__(self, parallel, sectionsize, loads, rate=None):
+        self.parallel = parallel
+        self.sectionsize = sectionsize
+        self.loads = loads
+        self.maxchannelbytes = max(loads) if loads else 0
+        # Predicted duration needs bytes per second that one channel processes, learned from earlier runs
+        self.seconds = self.maxchannelbytes / rate if rate else None
+
+    def balance(self):
+        # Average channel load compared to the busiest channel, 1.0 means all channels are evenly loaded
+        if self.maxchannelbytes == 0:
+            return 1.0
+        return sum(self.loads) / float(len(self.loads)) / self.maxchannelbytes
+
+    def sectionclause(self):
+        # Value for RMAN SECTION SIZE clause
+        if self.sectionsize is None:
+            return ''
+        return "section size %dM" % (self.sectionsize / 1048576)
+
+def sectionsize2bytes(value):
+    # Parses RMAN section size, for example 32G
+    m = re.match(r'^\s*(?:section\s+size\s+)?(\d+)\s*([KMG]?)\s*$', value or '', re.IGNORECASE)
+    if not m:
+        return None
+    return int(m.group(1)) * {'': 1, 'K': 1024, 'M': 1048576, 'G': 1073741824}[m.group(2).upper()]
+
+def channelloads(sizes, parallel, sectionsize=None):
+    # Splits datafiles to sections and assigns the largest remaining section to the least loaded channel
+    pieces = []
+    for size in sizes:
+        if sectionsize and size > sectionsize:
+            pieces.extend([sectionsize] * (size / sectionsize))
+            if size % sectionsize:
+                pieces.append(size % sectionsize)
+        else:
+            pieces.append(size)
+    loads = [0] * parallel
+    for piece in sorted(pieces, reverse=True):
+        loads[loads.index(min(loads))] += piece
+    return loads
+
+class RmanTuner(object):
+    # Chooses RMAN parallelism and section size from datafile sizes
+    # Smallest parallelism that gets within tolerance of the best achievable duration is preferred,
+    # since extra channels only add load to the database and storage when one large datafile dominates
+    _minsection = 1073741824
+    _tolerance = 1.1
+    _sectionsperchannel = 4
+
+    def __init__(self, sizes, maxparallel, rate=None):
+        self.sizes = [s for s in sizes if s > 0]
+        self.maxparallel = max(1, maxparallel)
+        self.rate = rate
+
+    def plan(self, parallel, sectionsize=None):
+        return RmanPlan(parallel, sectionsize, channelloads(self.sizes, parallel, sectionsize), self.rate)
+
+    def sectionsize(self, parallel):
+        # Section size is only needed when the largest datafile is larger than an even share of one channel
+        total = sum(self.sizes)
+        if parallel < 2 or not self.sizes or max(self.sizes) <= total / parallel:
+            return None
+        gigabytes = max(self._minsection, total / (parallel * self._sectionsperchannel)) / 1073741824
+        return max(1, gigabytes) * 1073741824
+
+    def recommend(self):
+        candidates = [self.plan(p, self.sectionsize(p)) for p in range(1, self.maxparallel+1)]
+        best = min([c.maxchannelbytes for c in candidates])
+        for c in candidates:
+            if c.maxchannelbytes <= best * self._tolerance:
+                return c
+
+def channelrate(dbfile, dbname, window=14):
+    # Median bytes per second processed by the busiest channel in the earlier imagecopy merges
+    store = MetricsStore(dbfile)
+    try:
+        series = store.series(dbname)
+    finally:
+        store.close()
+    maxbytes = dict([(starttime, value) for starttime, success, value in series.get(('backup', dbname, 'imagecopywithsnap', 'imagecopy_merge_maxchannelbytes'), []) if success])
+    rates = []
+    for starttime, success, seconds in series.get(('backup', dbname, 'imagecopywithsnap', 'imagecopy_merge_seconds'), []):
+        if success and seconds > 0 and maxbytes.get(starttime):
+            rates.append(maxbytes[starttime] / seconds)
+    return median(rates[-window:])
@@ -5,10 +5,12 @@ from datetime import datetime
 
 class SoftNASHttp(object):
     _timeout = 300 # HTTP call timeout in seconds
-    _cookies = {}
 
     def __init__(self, baseurl):
         self._baseurl = baseurl
+        # Session keeps the login cookies and the connection between requests
+        self._session = requests.Session()
+        self._session.verify = False
         try:
             requestwarning = __import__('requests.packages.urllib3.exceptions', globals(), locals(), ['InsecureRequestWarning'])
             requestwarningclass = getattr(requestwarning, 'InsecureRequestWarning')
@@ -18,8 +20,7 @@ class SoftNASHttp(object):
 
     def post(self, url, payload):
         debug("Sending POST to %s" % url)
-        r = requests.post("%s/%s" % (self._baseurl, url), cookies=self._cookies, verify=False, data=payload, timeout=self._timeout, allow_redirects=False)
-        self._cookies = r.cookies
+        r = self._session.post("%s/%s" % (self._baseurl, url), data=payload, timeout=self._timeout, allow_redirects=False)
         debug("Return code: %d" % r.status_code)
         try:
             j = json.loads(r.text)
@@ -29,7 +30,7 @@ class SoftNASHttp(object):
 
     def get(self, url):
         debug("Sending GET to %s" % url)
-        r = requests.get("%s/%s" % (self._baseurl, url), cookies=self._cookies, verify=False, timeout=self._timeout, allow_redirects=False)
+        r = self._session.get("%s/%s" % (self._baseurl, url), timeout=self._timeout, allow_redirects=False)
         debug("Return code: %d" % r.status_code)
         return r.status_code
 
@@ -41,6 +42,7 @@ class SoftNAS(SnapHandler):
     _username = None
     _password = None
     _http = None
+    _loggedin = False
 
     def __init__(self, configname):
         credfilename = os.path.join(scriptpath(), 'softnascredentials.cfg')
@@ -60,24 +62,36 @@ class SoftNAS(SnapHandler):
         self._http = SoftNASHttp(url)
         super(SoftNAS, self).__init__(configname)
 
+    def __del__(self):
+        try:
+            self._logout()
+        except:
+            pass
+
     def _login(self):
         j,r = self._http.post('login.php', { 'username': self._username, 'password': self._password })
+        self._loggedin = True
 
     def _logout(self):
-        r = self._http.get('logout.php')
+        if self._loggedin:
+            r = self._http.get('logout.php')
+            self._loggedin = False
 
     def _request(self, opcode, parameters={}, sendJSON=False):
         payload = {'opcode': opcode}
         payload.update(parameters)
         if sendJSON:
             payload = json.dumps(payload)
-        self._login()
-        try:
+        # Login session is kept for all requests
+        if not self._loggedin:
+            self._login()
+        j,r = self._http.post('snserver/snserv.php', payload)
+        if r in [302, 401]:
+            debug("SoftNAS session has expired, logging in again")
+            self._login()
             j,r = self._http.post('snserver/snserv.php', payload)
-            if not j['success']:
-                raise Exception('softnas',"Request failed. Return code: %d, message: %s" % (r, j))
-        finally:
-            self._logout()
+        if not j.get('success', False):
+            raise Exception('softnas',"Request failed. Return code: %d, message: %s" % (r, j))
         return j
     
     def _listvolumes(self):
@@ -96,12 +110,25 @@ class SoftNAS(SnapHandler):
         i2 = j['msg'].find("'", i)
         return j['msg'][i+1:i2]
 
+    def _deletesnaps(self, snapids):
+        # snapcommand delete accepts a list of snapshots, so all snapshots are dropped with one request
+        snapshots = [json.dumps({'snapshot_name': snapid, 'pool_name': self._pool, 'volume_name': self._filesystem}) for snapid in snapids]
+        self._request('snapcommand', {'command': 'delete', 'snapshots': "[%s]" % ",".join(snapshots)} )
+
     def dropsnap(self, snapid):
-        j = self._request('snapcommand', {'command': 'delete', 'snapshots': "[%s]" % json.dumps({'snapshot_name': snapid, 'pool_name': self._pool, 'volume_name': self._filesystem}) } )
+        self._deletesnaps([snapid])
+
+    def dropsnaps(self, snapids):
+        try:
+            self._deletesnaps(snapids)
+        except Exception as detail:
+            # Bulk request failed as a whole, so none of the snapshots is reported as dropped
+            debug("Dropping snapshots %s failed: %s" % (", ".join(snapids), detail))
+            return set(snapids)
+        return set()
 
     def listsnapshots(self, sortbycreation=False, sortreverse=False):
         j = self._request('snapshotlist', {'pool_name': "%s/%s" % (self._pool, self._filesystem)})
-        self._listvolumes()
         snapshots = []
         for s in j['records']:
             snapshots.append( {'id': s['snapshot_name'],
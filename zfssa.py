@@ -3,13 +3,18 @@ from backupcommon import SnapHandler, Configuration, scriptpath, size2str, info,
 from ConfigParser import SafeConfigParser
 from datetime import datetime, timedelta
 from urlparse import urlparse
+from requests.adapters import HTTPAdapter
+try:
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+    Retry = None
 
 class ZFSHttp(object):
     _jsonheader = {'Content-Type': 'application/json'}
     _timeout = 300 # HTTP call timeout in seconds
     server_address = None
 
-    def __init__(self, baseurl, auth):
+    def __init__(self, baseurl, auth, poolsize=4, retries=3):
         self._baseurl = baseurl
         self._auth = auth
         up = urlparse(self._baseurl)
@@ -23,16 +28,56 @@ class ZFSHttp(object):
             requests.packages.urllib3.disable_warnings(requestwarningclass)
         except AttributeError:
             pass
+        # One keep-alive session is used for all calls, so TLS handshake is done only when a new connection is needed
+        self._roundtrips = 0
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolsize, max_retries=self._retry(retries))
+        self._session = requests.Session()
+        self._session.auth = self._auth
+        self._session.headers.update(self._jsonheader)
+        self._session.verify = False
+        self._session.mount('https://', self._adapter)
+        self._session.mount('http://', self._adapter)
+
+    def _retry(self, retries):
+        # Requests that fail with a gateway error are retried only when it is safe to repeat them
+        if Retry is None:
+            return retries
+        kwargs = {'total': retries, 'backoff_factor': 1, 'status_forcelist': [502, 503, 504]}
+        methods = frozenset(['GET', 'DELETE'])
+        # raise_on_status=False returns the final response after the last retry, so the return code checks below still apply
+        # Older urllib3 versions know only method_whitelist and may not support raise_on_status
+        for extra in [{'allowed_methods': methods, 'raise_on_status': False}, {'method_whitelist': methods, 'raise_on_status': False}]:
+            try:
+                return Retry(**dict(kwargs, **extra))
+            except TypeError:
+                pass
+        # Without raise_on_status gateway errors are not retried, so the final response is still checked by the callers
+        return Retry(total=retries, backoff_factor=1, method_whitelist=methods)
 
     def _array2url(self, urlarray):
         # Converts list of url components as a quoted URL
         return '/'.join(map(urllib.quote_plus, urlarray))
 
+    def _request(self, method, url, payload=None):
+        debug("Sending %s to %s" % (method, url))
+        self._roundtrips += 1
+        data = json.dumps(payload) if payload is not None else None
+        r = self._session.request(method, "%s/%s" % (self._baseurl, url), data=data, timeout=self._timeout)
+        debug("Return code: %d" % r.status_code)
+        return r
+
+    def stats(self):
+        # Number of API round trips and new connections (TLS handshakes) made by this session
+        connections = 0
+        try:
+            connections = self._adapter.poolmanager.connection_from_url(self._baseurl).num_connections
+        except AttributeError:
+            pass
+        return {'roundtrips': self._roundtrips, 'handshakes': connections}
+
     def get(self, urlarray, return_json=True):
         url = self._array2url(urlarray)
-        debug("Sending GET to %s" % url)
-        r = requests.get("%s/%s" % (self._baseurl, url), auth=self._auth, headers=self._jsonheader, verify=False, timeout=self._timeout)
-        debug("Return code: %d" % r.status_code)
+        r = self._request('GET', url)
         if r.status_code != 200:
             error("GET to %s returned %d" % (url, r.status_code))
             raise Exception('zfssareturncode',"GET request return code is not 200 (%s)" % r.status_code)
@@ -44,9 +89,7 @@ class ZFSHttp(object):
 
     def post(self, urlarray, payload):
         url = self._array2url(urlarray)
-        debug("Sending POST to %s" % url)
-        r = requests.post("%s/%s" % (self._baseurl, url), auth=self._auth, headers=self._jsonheader, verify=False, data=json.dumps(payload), timeout=self._timeout)
-        debug("Return code: %d" % r.status_code)
+        r = self._request('POST', url, payload)
         if r.status_code == 201:
             j = json.loads(r.text)
         else:
@@ -56,9 +99,7 @@ class ZFSHttp(object):
 
     def put(self, urlarray, payload):
         url = self._array2url(urlarray)
-        debug("Sending PUT to %s" % url)
-        r = requests.put("%s/%s" % (self._baseurl, url), auth=self._auth, headers=self._jsonheader, verify=False, data=json.dumps(payload), timeout=self._timeout)
-        debug("Return code: %d" % r.status_code)
+        r = self._request('PUT', url, payload)
         if r.status_code == 201:
             j = json.loads(r.text)
         else:
@@ -68,9 +109,7 @@ class ZFSHttp(object):
 
     def delete(self, urlarray):
         url = self._array2url(urlarray)
-        debug("Sending DELETE to %s" % url)
-        r = requests.delete("%s/%s" % (self._baseurl, url), auth=self._auth, headers=self._jsonheader, verify=False, timeout=self._timeout)
-        debug("Return code: %d" % r.status_code)
+        r = self._request('DELETE', url)
         return r.status_code
 
 class ZFSSA(SnapHandler):
@@ -90,9 +129,23 @@ class ZFSSA(SnapHandler):
         self._project = Configuration.get('project', 'zfssa')
         self._filesystem = configname
         #
-        self._http = ZFSHttp(zfssaurl, zfsauth)
+        try:
+            poolsize = int(Configuration.get('poolsize', 'zfssa'))
+        except:
+            poolsize = 4
+        try:
+            retries = int(Configuration.get('retries', 'zfssa'))
+        except:
+            retries = 3
+        self._http = ZFSHttp(zfssaurl, zfsauth, poolsize, retries)
         super(ZFSSA, self).__init__(configname)
 
+    def __del__(self):
+        try:
+            debug("ZFSSA API session statistics: %s" % self._http.stats())
+        except:
+            pass
+
     def str2date(self, zfsdate):
         # ZFS returned string to datetime object
         # 20150803T13:31:42
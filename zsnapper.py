@@ -2,6 +2,7 @@
 
 import sys
 from backupcommon import Configuration, create_snapshot_class
+from metrics import record_run
 from datetime import datetime, timedelta
 
 # Check command line arguments
@@ -22,13 +23,8 @@ def checkage():
   warning = timedelta(hours = int(Configuration.get('warningsnapage', 'generic')))
   critical = timedelta(hours = int(Configuration.get('criticalsnapage', 'generic')))
   try:
-    snaps = zfs.listsnapshots()
-    minage = None
-    for s in snaps:
-      d = zfs.str2date(s["creation"])
-      age = datetime.utcnow() - d
-      if (minage is None) or (age < minage):
-        minage = age
+    latest = zfs.snapindex().latest()
+    minage = (datetime.utcnow() - latest.creation) if latest is not None else None
     s = "OK"
     if (minage is None) or (minage >= critical):
       exitcode = 2
@@ -59,28 +55,47 @@ def clone_snapshot(source=None, clone=None):
   print "Mount command (execute as root and replace zfs ip address and mount directory):"
   print "mount -t nfs -o rw,bg,hard,nointr,rsize=32768,wsize=32768,tcp,vers=3,timeo=600 %s <mount_directory_here>" % zfs.mountstring(clonename)
 
+if sys.argv[2] == 'clean' and len(sys.argv) == 4 and sys.argv[3] != '--plan':
+  print "Usage: zsnapper.py <config> clean [--plan]"
+  sys.exit(2)
+
 # Call the correct procedure based on parameters
-if sys.argv[2] == 'clean':
-  output = zfs.clean()
-  for s in output:
-    print s['infostring']
-elif sys.argv[2] == 'create':
-  snapname = zfs.snap()
-  print "Snapshot created: %s" % snapname
-elif sys.argv[2] == 'clone':
-  clone_snapshot()
-elif sys.argv[2] == 'checkage':
-  checkage()
-elif sys.argv[2] == 'dropclone':
-  zfs.dropclone(sys.argv[3])
-  print "Clone dropped."
-elif sys.argv[2] == 'listclones':
-  for s in zfs.listclones():
-    print zfs.clone2str(s)
-elif sys.argv[2] == 'autoclone':
-  zfs.autoclone()
-  print "Clone created."
-else:
-  snaps = zfs.listsnapshots()
-  for s in snaps:
-     print zfs.snap2str(zfs.getsnapinfo(s))
+runstart = datetime.now()
+runsuccess = False
+runvalues = {}
+# Storage changing operations are recorded to the metrics store
+recordrun = sys.argv[2] in ['clean','create','clone','dropclone','autoclone'] and '--plan' not in sys.argv
+try:
+  if sys.argv[2] == 'clean':
+    output = zfs.clean(planonly=(len(sys.argv) == 4))
+    runvalues = {'snapshots': 0, 'dropped': 0}
+    for s in output:
+      print s['infostring']
+      runvalues['snapshots']+= 1
+      if s['dropped']:
+        runvalues['dropped']+= 1
+  elif sys.argv[2] == 'create':
+    snapname = zfs.snap()
+    print "Snapshot created: %s" % snapname
+  elif sys.argv[2] == 'clone':
+    clone_snapshot()
+  elif sys.argv[2] == 'checkage':
+    checkage()
+  elif sys.argv[2] == 'dropclone':
+    zfs.dropclone(sys.argv[3])
+    print "Clone dropped."
+  elif sys.argv[2] == 'listclones':
+    for s in zfs.listclones():
+      print zfs.clone2str(s)
+  elif sys.argv[2] == 'autoclone':
+    zfs.autoclone()
+    print "Clone created."
+  else:
+    snaps = zfs.listsnapshots()
+    for s in snaps:
+       print zfs.snap2str(zfs.getsnapinfo(s))
+  runsuccess = True
+finally:
+  if recordrun:
+    runvalues['duration_seconds'] = (datetime.now() - runstart).total_seconds()
+    record_run('zsnapper', configsection, sys.argv[2], runstart, runsuccess, runvalues)